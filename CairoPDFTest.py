@@ -86,9 +86,30 @@ def render_multipage_pdf (htmlfns, cssfns, pdffn) :
 
         surface.show_page()
 
+def render_paginated_pdf (htmlfn, cssfn, pdffn) :
+    """long documents can be broken into pages of a fixed height,
+    pages are laid out and rendered lazily one at a time"""
+
+    with open(htmlfn) as f:
+        html = f.read()
+    with open(cssfn) as f:
+        css = f.read()
+
+    # For PDF files, width and height are in "point" units (1/72 of an inch)
+    WIDTH, HEIGHT = 14*72, 8.5*72
+
+    surface = cairo.PDFSurface (pdffn, WIDTH, HEIGHT)
+    ctx = cairo.Context (surface)
+
+    rob = robinson.html (html, css, WIDTH, load_resourcefn, text_extents, font_extents, ctx, lazy=True)
+
+    for page in rob.render_pages(ctx, HEIGHT):
+        surface.show_page()
+
 
 render_pdf ('test/splash.html', 'test/splash.css', 'splash.pdf')
 render_pdf ('test/weather.html', 'test/weather.css', 'weather.pdf')
 render_multipage_pdf(['test/splash.html', 'test/weather.html'], 
                      ['test/splash.css', 'test/weather.css'], 
                     'combined.pdf')
+render_paginated_pdf ('test/weather.html', 'test/weather.css', 'weather_paginated.pdf')
@@ -29,7 +29,9 @@
 #
 from __future__ import print_function
 
-import re, os
+import re, os, math
+import threading
+from collections import deque
 try:
     from StringIO import StringIO
 except:
@@ -41,25 +43,69 @@ import cssselect
 import cairo
 import traceback
 import time
-import cProfile, pstats
 import sys
 
 PYVER = sys.version_info.major
 
 try:
-    from style import Value, get_style_string
+    from style import Value, get_style_string, style_values
 except:
-    from .style import Value, get_style_string
+    from .style import Value, get_style_string, style_values
 
 try:
-    from layout import Dimensions, LayoutBox, LayoutContext
+    from displaylist import DisplayList
 except:
-    from .layout import Dimensions, LayoutBox, LayoutContext
+    from .displaylist import DisplayList
 
+try:
+    from spatial import SpatialIndex
+except:
+    from .spatial import SpatialIndex
 
-VERBOSE = False
+try:
+    from framebuffer import surface_for_buffer
+except:
+    from .framebuffer import surface_for_buffer
 
-img_cache       = {}
+try:
+    from imagecache import ImageCache, png_size
+except:
+    from .imagecache import ImageCache, png_size
+
+try:
+    from output import encode, SURFACE_FORMATS
+except:
+    from .output import encode, SURFACE_FORMATS
+
+try:
+    from metrics import TextMetrics
+except:
+    from .metrics import TextMetrics
+
+try:
+    from batch import render_many
+except:
+    from .batch import render_many
+
+if PYVER >= 3:
+    try:
+        from aio import render_async
+    except:
+        from .aio import render_async
+
+try:
+    from layout import Dimensions, LayoutBox, LayoutContext, LayoutCache, LayerCache, LayoutPool, \
+                       Deadline, RenderTimeout, RenderCancelled
+except:
+    from .layout import Dimensions, LayoutBox, LayoutContext, LayoutCache, LayerCache, LayoutPool, \
+                        Deadline, RenderTimeout, RenderCancelled
+
+
+# clip rectangles used for horizontally unbounded bands
+MAX_COORD = 1000000.0
+
+# decoded images, shared by all html instances not given an image_cache of their own
+shared_image_cache = ImageCache()
 
 #
 # helper / debug functions
@@ -79,12 +125,51 @@ def pprint_ltree (box, indent):
 def speci2prio(speci):
     return speci[0] * 10000 + speci[1] * 100 + speci[2]
 
+def has_text(text):
+    return text is not None and len(text.strip()) > 0
+
 #
 # main robinson html render class
 #
 
 class html(object):
 
+    #
+    # layout object allocation, optionally backed by a LayoutPool
+    #
+
+    def new_box (self, parent, box_type, node, style, text=None):
+        if self.pool is None:
+            return LayoutBox (self, parent, box_type, node, style, text)
+        return self.pool.box (self, parent, box_type, node, style, text)
+
+    def new_context (self, parent, containing_block_dim, text_alignment):
+        if self.pool is None:
+            return LayoutContext (parent, containing_block_dim, text_alignment)
+        return self.pool.context (parent, containing_block_dim, text_alignment)
+
+    def release_context (self, lc):
+        if self.pool is not None:
+            self.pool.release_context (lc)
+
+    def new_dim (self):
+        if self.pool is None:
+            return Dimensions ()
+        return self.pool.dim ()
+
+    def release_dim (self, d):
+        if self.pool is not None:
+            self.pool.release_dim (d)
+
+    def release (self):
+        """ hand the layout tree back to the pool, the next render() lays out again """
+
+        if self.pool is not None and self.ltree is not None:
+            self.pool.release (self.ltree)
+        self.ltree      = None
+        self.index      = None
+        self.node_boxes = {}
+
     def _build_text_boxes (self, root, text):
         """ create text box if we have text """
 
@@ -113,11 +198,11 @@ class html(object):
 
         ic = root.get_inline_container()
         for part in parts:
-            b = LayoutBox (self, ic, 'inline', None, None, part+' ') 
+            b = self.new_box (ic, 'inline', None, None, part+' ') 
             ic.children.append (b)
 
 
-    def _build_layout_tree (self, parent, node, style_map):
+    def _build_layout_tree (self, parent, node, style_map, node_boxes=None):
         """ Build the tree of LayoutBoxes, but don't perform any layout calculations yet. """
 
         #print "layout_tree: working on %s %s text:%s tail:%s" % (node.tag, node.attrib, repr(node.text), repr(node.tail))
@@ -132,7 +217,9 @@ class html(object):
         else:
             raise Exception ('Root node has display: none.')
 
-        root = LayoutBox (self, parent, box_type, node, style) 
+        root = self.new_box (parent, box_type, node, style) 
+        if node_boxes is not None:
+            node_boxes[node] = root
         self._build_text_boxes (root, node.text)
 
         # Create the descendant boxes.
@@ -146,19 +233,78 @@ class html(object):
                 pass
             elif display == 'inline' or display == 'img':
                 ic = root.get_inline_container()
-                ic.children.append (self._build_layout_tree(ic, child, style_map))
+                ic.children.append (self._build_layout_tree(ic, child, style_map, node_boxes))
             else:
-                root.children.append (self._build_layout_tree(root, child, style_map))
+                root.children.append (self._build_layout_tree(root, child, style_map, node_boxes))
 
             # create text box if we have tail text
             self._build_text_boxes (root, child.tail)
 
         return root
 
+    def _build_lazy_box (self, parent, node):
+        """ like _build_layout_tree, but streamable containers get their children built on demand """
+
+        style   = self.style_map[node]
+        display = get_style_string (u'display', style, 'block')
+
+        if display == 'block' or (display == 'table' and get_style_string (u'table-layout', style, 'auto') == 'fixed'):
+            box = self.new_box (parent, display, node, style)
+            box.lazy = True
+            return box
+
+        return self._build_layout_tree (parent, node, self.style_map)
+
+    def _iter_child_boxes (self, root, after=None):
+        """ Generate the child boxes of root one at a time. For boxes built by _build_lazy_box,
+        inline content is collected into anonymous boxes which are generated once complete,
+        block children are built lazily themselves. after resumes behind that node child
+        (the node of a block, see root.last_block), no boxes are built for the ones before. """
+
+        if not root.lazy:
+            for child in list(root.children):
+                yield child
+            return
+
+        node = root.node
+        ic   = None
+
+        text = node.text if after is None else after.tail
+        if has_text (text):
+            ic = root.get_inline_container()
+            self._build_text_boxes (ic, text)
+
+        for child in (node if after is None else after.itersiblings()):
+
+            display = get_style_string (u'display', self.style_map[child], 'block')
+
+            if display == 'none':
+                pass
+            elif display == 'inline' or display == 'img':
+                if ic is None:
+                    ic = root.get_inline_container()
+                ic.children.append (self._build_layout_tree(ic, child, self.style_map))
+            else:
+                if ic is not None:
+                    yield ic
+                    ic = None
+                box = self._build_lazy_box (root, child)
+                root.children.append (box)
+                root.last_block = child
+                yield box
+
+            if has_text (child.tail):
+                if ic is None:
+                    ic = root.get_inline_container()
+                self._build_text_boxes (ic, child.tail)
+
+        if ic is not None:
+            yield ic
+
     def _layout_tree (self, root, style_map, containing_block_dim):
         """Transform a lxml node tree into a layout tree"""
 
-        root_box = self._build_layout_tree(None, root, style_map)
+        root_box = self._build_layout_tree(None, root, style_map, self.node_boxes)
         #pprint_ltree (root_box, 0)
 
         lc = LayoutContext (None, containing_block_dim, 'left')
@@ -168,78 +314,742 @@ class html(object):
 
     def load_image (self, imagefn):
 
-        global img_cache
-
-        if VERBOSE:
+        if self.verbose:
             print("robinson: load_image(%s)..." % imagefn)
 
-        if not imagefn in img_cache:
+        return self.image_cache.get (imagefn, self._decode_image)
 
-            if VERBOSE:
-                print("robinson: load_image CACHE MISS")
+    def load_scaled_image (self, imagefn, width, height, filter=cairo.FILTER_GOOD):
+        """ image scaled to width x height pixels using filter, scaled copies are kept in
+        the image cache keyed (imagefn, width, height, filter) """
 
-            pngstr = self.load_resourcefn (imagefn)
+        return self.image_cache.get ((imagefn, width, height, filter), self._scale_image)
 
-            if PYVER == 2:
-                sio = StringIO(str(pngstr))
-            else:
-                from io import BytesIO
-                sio = BytesIO(pngstr)
+    def _scale_image (self, key):
+
+        imagefn, width, height, filter = key
+
+        img = self.load_image (imagefn)
+
+        scaled = cairo.ImageSurface (cairo.FORMAT_ARGB32, width, height)
+        ctx    = cairo.Context (scaled)
+        ctx.scale (float(width) / img.get_width(), float(height) / img.get_height())
+        ctx.set_source_surface (img, 0, 0)
+        ctx.get_source().set_filter (filter)
+        ctx.paint ()
+        del ctx
+        scaled.flush ()
 
+        return scaled
+
+    def prefetch (self, executor=None, workers=8):
+        """ Fetch all resources referenced by src attributes which are neither decoded nor
+        fetched yet concurrently, in executor or a temporary pool of workers threads, and
+        keep them in the image cache for layout + rendering. Failed loads are skipped,
+        they are retried (and raise) when the image is laid out. """
+
+        srcs = []
+        for src in self.document.xpath ('//*[@src]/@src'):
+            src = str(src)
+            if src in srcs or self.image_cache.size_of (src) is not None or self.image_cache.get_raw (src) is not None:
+                continue
+            srcs.append (src)
+
+        if not srcs:
+            return
+
+        def fetch (src):
             try:
-                img_cache[imagefn] = cairo.ImageSurface.create_from_png(sio)
+                return self.load_resourcefn (src)
             except:
-                traceback.print_exc()
-                img_cache[imagefn] = cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1)
-                
-            sio.close()
+                return None
+
+        if executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor (max_workers=min(workers, len(srcs))) as pool:
+                results = list(pool.map (fetch, srcs))
+        else:
+            results = list(executor.map (fetch, srcs))
+
+        for src, data in zip(srcs, results):
+            if data is None:
+                continue
+            size = png_size (data)
+            if size is not None:
+                self.image_cache.set_size (src, size)
+            self.image_cache.put_raw (src, data)
+
+    def image_size (self, imagefn):
+        """ (width, height) of an image, read from its PNG header without decoding it """
+
+        size = self.image_cache.size_of (imagefn)
+        if size is not None:
+            return size
+
+        data = self.image_cache.get_raw (imagefn)
+        if data is None:
+            data = self.load_resourcefn (imagefn)
+
+        size = png_size (data)
+        if size is None:
+            # not a PNG, the decoder deals with it
+            img  = self.load_image (imagefn)
+            size = (img.get_width(), img.get_height())
+        else:
+            # keep the data around for decoding at render time
+            self.image_cache.put_raw (imagefn, data)
+
+        self.image_cache.set_size (imagefn, size)
+
+        return size
+
+    def _decode_image (self, imagefn):
+
+        if self.verbose:
+            print("robinson: load_image CACHE MISS")
+
+        pngstr = self.image_cache.pop_raw (imagefn)
+        if pngstr is None:
+            pngstr = self.load_resourcefn (imagefn)
+
+        if self.image_store is not None:
+            return self.image_store.load (pngstr, self._decode_png)
+
+        return self._decode_png (pngstr)
+
+    def _decode_png (self, pngstr):
+
+        if PYVER == 2:
+            sio = StringIO(str(pngstr))
+        else:
+            from io import BytesIO
+            sio = BytesIO(pngstr)
+
+        try:
+            img = cairo.ImageSurface.create_from_png(sio)
+        except:
+            traceback.print_exc()
+            img = cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1)
+
+        sio.close()
+
+        return img
+
+    def _update_layout (self):
+
+        with self.lock:
+            if self.ltree is None:
+                self.ltree = self._layout_tree (self.document.getroot(), self.style_map, self.viewport)
+
+            self.relayout()
+
+    def render (self, ctx, clip=None):
+        """ render the document onto ctx. If clip (x, y, width, height) is given, only that
+        area is painted and only boxes intersecting it are visited (see get_index()). """
+
+        self._update_layout()
+
+        if clip is None:
+            self._render_document_background (ctx, self.ltree)
+            self.ltree.render(ctx)
+            return
+
+        x, y, w, h = clip
+
+        ctx.save()
+        ctx.rectangle (x, y, w, h)
+        ctx.clip()
+
+        self._render_document_background (ctx, self.ltree)
+        for entry in self.get_index().query (x, y, x + w, y + h):
+            c = entry[6]
+            if c is None:
+                entry[1].render_box (ctx)
+                continue
+            # inside an overflow: hidden box
+            ctx.save()
+            ctx.rectangle (c[0], c[1], c[2] - c[0], c[3] - c[1])
+            ctx.clip()
+            entry[1].render_box (ctx)
+            ctx.restore()
+
+        ctx.restore()
+
+    def render_to_buffer (self, buf, width, height, stride=None, format=cairo.FORMAT_ARGB32, clip=None):
+        """ Render the document directly into buf, a writable buffer (numpy array, mmap,
+        framebuffer memoryview) holding height rows of stride bytes (default: the stride
+        cairo requires for width) in cairo pixel format format, e.g. FORMAT_RGB16_565 for
+        panels taking 565 pixels natively. See robinson.framebuffer for conversions
+        to other panel formats. """
+
+        surface = surface_for_buffer (buf, width, height, stride, format)
+
+        ctx = cairo.Context (surface)
+        self.render (ctx, clip)
+        del ctx
+
+        surface.flush()
+        surface.finish()
+
+    def document_size (self):
+        """ (width, height) in whole pixels: layout width x bottom of the laid out document """
+
+        self._update_layout()
+
+        mb = self.ltree.dimensions.margin_box()
+
+        return int(math.ceil(self.viewport.content.width)), int(math.ceil(mb.y + mb.height))
+
+    def render_output (self, f, format='png', width=None, height=None,
+                       surface_format=cairo.FORMAT_ARGB32, encoder=None, **options):
+        """ Render the document into a new width x height ImageSurface (default: layout
+        width x document height) and encode it into f (file-like object or file name),
+        see robinson.output.encode() for formats and options. If encoder (a
+        robinson.output.FrameEncoder) is given, encoding happens on its background
+        thread and format / options are taken from it. surface_format has to be
+        cairo.FORMAT_ARGB32 or FORMAT_RGB24. Returns the surface. """
+
+        if not surface_format in SURFACE_FORMATS:
+            raise ValueError ("render_output: unsupported surface format %s, use ARGB32 or RGB24" % surface_format)
+
+        dw, dh = self.document_size()
+        if width is None:
+            width = dw
+        if height is None:
+            height = dh
+
+        surface = cairo.ImageSurface (surface_format, width, height)
+        ctx     = cairo.Context (surface)
+        self.render (ctx)
+        del ctx
+        surface.flush()
+
+        if encoder is not None:
+            encoder.submit (surface, f)
+        else:
+            encode (surface, f, format, **options)
+
+        return surface
+
+    def render_tiles (self, tile_width, tile_height, callback, width=None, height=None,
+                      format=cairo.FORMAT_ARGB32, executor=None, max_pending=8):
+        """ Rasterize the document in tiles of tile_width x tile_height pixels (smaller at
+        the right and bottom edges), callback(surface, x, y) receives each finished tile
+        in row major order from the calling thread. width/height default to the layout
+        width and the document height.
+
+        The document is compiled into a display list once, its items are bucketed by
+        their bounds so every tile only replays what touches it. Tiles are rasterized in
+        executor (a concurrent.futures executor, sequentially if None) with at most
+        max_pending tiles in flight, so memory is bounded by the tile size. """
+
+        dl = self.compile()
+
+        dw, dh = self.document_size()
+        if width is None:
+            width = dw
+        if height is None:
+            height = dh
+
+        cols  = (width  + tile_width  - 1) // tile_width
+        rows  = (height + tile_height - 1) // tile_height
+        tiles = [[] for i in range(cols * rows)]
+
+        for item in dl:
+            if item.kind == 'paint':
+                for items in tiles:
+                    items.append (item)
+                continue
+
+            # one pixel of slack for antialiasing
+            x0, y0, x1, y1 = item.bbox
+            c0 = max(int(math.floor((x0 - 1) / tile_width)), 0)
+            c1 = min(int(math.floor((x1 + 1) / tile_width)), cols - 1)
+            r0 = max(int(math.floor((y0 - 1) / tile_height)), 0)
+            r1 = min(int(math.floor((y1 + 1) / tile_height)), rows - 1)
+            for row in range(r0, r1 + 1):
+                for col in range(c0, c1 + 1):
+                    tiles[row * cols + col].append (item)
+
+        pending = deque()
+
+        for i, items in enumerate(tiles):
+
+            x = (i % cols)  * tile_width
+            y = (i // cols) * tile_height
+            w = min(tile_width,  width  - x)
+            h = min(tile_height, height - y)
+
+            # drop the reference, the tile owns its items from here on
+            tiles[i] = None
+
+            if executor is None:
+                callback (self._render_tile (items, x, y, w, h, format), x, y)
+                continue
+
+            pending.append ((executor.submit (self._render_tile, items, x, y, w, h, format), x, y))
+            if len(pending) >= max_pending:
+                future, tx, ty = pending.popleft()
+                callback (future.result(), tx, ty)
 
-        return img_cache[imagefn]
+        while pending:
+            future, tx, ty = pending.popleft()
+            callback (future.result(), tx, ty)
 
-    def render (self, ctx):
+    def _render_tile (self, items, x, y, w, h, format):
+
+        dl = DisplayList()
+        dl.items = items
+
+        surface = cairo.ImageSurface (format, w, h)
+        ctx     = cairo.Context (surface)
+        ctx.translate (-x, -y)
+        dl.replay (ctx)
+        surface.flush()
+
+        return surface
+
+    def get_index (self):
+        """ spatial index over the current layout, built on first use after (re)layout """
+
+        with self.lock:
+            self._update_layout()
+
+            if self.index is None:
+                self.index = SpatialIndex (self.ltree)
+            return self.index
+
+    def hit_test (self, x, y):
+        """ (box, node) for the deepest, topmost box whose border box contains x/y and the
+        lxml node it was generated for (that of its nearest ancestor for anonymous boxes),
+        (None, None) if nothing is hit. Backed by get_index(). """
+
+        entries = self.get_index().at (x, y)
+        if not entries:
+            return None, None
+
+        # in paint order, descendants follow their ancestors: the last hit is the deepest
+        box  = entries[-1][1]
+        node = None
+        b    = box
+        while b is not None:
+            if b.node is not None:
+                node = b.node
+                break
+            b = b.parent
+
+        return box, node
+
+    def compile (self, cull_occluded=False):
+        """ Compile the laid out document into a DisplayList: flat draw operations with
+        styles resolved and same-colored adjacent rectangles merged, which can be
+        replayed onto any number of cairo contexts. cull_occluded drops everything
+        hidden below later opaque fills and images (DisplayList.cull_occluded()). """
+
+        self._update_layout()
+
+        dl = DisplayList()
 
         color = self.ltree.get_color ('background')
+        if color is not None:
+            dl.add_paint (color)
+
+        self.ltree.compile (dl)
+
+        if cull_occluded:
+            dl.cull_occluded ()
+
+        return dl
+
+    def render_update (self, ctx, previous=None, max_rects=8, cull_occluded=False):
+        """ Render the current state of the document into ctx, whose target still holds the
+        frame rendered from the display list previous, repainting only what changed.
+        Returns (display list, damaged rects): pass the display list back as previous
+        on the next call, the rects (x, y, width, height) tell which parts of the target
+        need to be pushed to the device. Without a previous frame (or when the document
+        background changed) the whole target, ctx.clip_extents(), is repainted. """
+
+        dl    = self.compile (cull_occluded=cull_occluded)
+        rects = dl.damage (previous, max_rects=max_rects)
+
+        if rects is None:
+            x0, y0, x1, y1 = ctx.clip_extents()
+            dl.replay (ctx)
+            return dl, [(x0, y0, x1 - x0, y1 - y0)]
+
+        paint = dl.items and dl.items[0].kind == 'paint'
+
+        for clip in rects:
+            ctx.save()
+            ctx.rectangle (clip[0], clip[1], clip[2], clip[3])
+            ctx.clip()
+            if not paint:
+                # no document background: damaged areas start out transparent
+                ctx.set_operator (cairo.OPERATOR_CLEAR)
+                ctx.paint()
+                ctx.set_operator (cairo.OPERATOR_OVER)
+            dl.replay (ctx, clip)
+            ctx.restore()
+
+        return dl, rects
+
+    def _render_document_background (self, ctx, root):
+
+        color = root.get_color ('background')
         if color is not None:
             ctx.set_source_rgba(color[0], color[1], color[2], 1.0)
             ctx.paint()
 
-        self.ltree.render(ctx)
+    #
+    # streamed layout + rendering: boxes are laid out one at a time and released
+    # once they have been painted, so memory stays bounded for long documents
+    #
 
-    def __init__(self, html, css, width, load_resourcefn, text_extents, font_extents, user_data):
+    def _stream_root (self):
+        """ fresh, lazily built layout tree root + layout context for streamed layout """
 
-        self.text_extents    = text_extents
-        self.font_extents    = font_extents
-        self.load_resourcefn = load_resourcefn
-        self.user_data       = user_data
+        root = self._build_lazy_box (None, self.document.getroot())
+        lc   = LayoutContext (None, self.viewport, 'left')
 
-        if VERBOSE:
-            start = time.clock()
-            end   = time.clock()
-            print("robinson: %8.3fs lxml parsing..." % (end-start))
+        return root, lc
 
-            pr = cProfile.Profile()
+    def _render_band (self, ctx, root, y0, y1):
+        """ render the live part of a streamed layout tree, clipped to y0 <= y < y1 """
 
-        root = etree.fromstring(html)
-        document = etree.ElementTree(root)
+        # boxes still being laid out extend below the band
+        box = root
+        while box is not None and box.open:
+            d = box.dimensions
+            if box.style is not None and 'height' in box.style:
+                d.content.height = box.get_style ("height", None, None).to_px()
+            else:
+                d.content.height = max (y1 - d.content.y, 0.0) + d.padding.bottom + d.border.bottom + 1.0
+            box = box.children[-1] if box.children else None
+
+        ctx.save()
+        ctx.rectangle (-MAX_COORD, y0, 2 * MAX_COORD, y1 - y0)
+        ctx.clip()
+        root.render (ctx)
+        ctx.restore()
+
+    def _retire_boxes (self, root, y):
+        """ release completed boxes which lie above y """
+
+        box = root
+        while box is not None and box.open:
+            children = []
+            for child in box.children:
+                mb = child.dimensions.margin_box()
+                if child.open or mb.y + mb.height > y:
+                    children.append (child)
+                elif self.pool is not None:
+                    self.pool.release (child)
+            box.children = children
+            box = box.children[-1] if box.children else None
+
+    def render_stream (self, ctx):
+        """ Lay out and render the document incrementally onto ctx, top to bottom.
+
+        Only the boxes currently being laid out and those not completely painted yet are
+        kept in memory (table-layout: fixed tables are streamed row by row). Works on its
+        own layout tree, independent of self.ltree. Returns the document height. """
+
+        root, lc = self._stream_root ()
+
+        self._render_document_background (ctx, root)
+
+        y      = 0.0
+        bottom = 0.0
+        for box in root.layout_stream (lc):
+
+            mb     = box.dimensions.margin_box()
+            bottom = mb.y + mb.height
+            if bottom > y:
+                self._render_band (ctx, root, y, bottom)
+                y = bottom
+
+            self._retire_boxes (root, y)
+
+        return bottom
+
+    def _page_break (self, root, y0, y1):
+        """ move a page break at y1 up to the top of the first line / leaf box it would cut """
+
+        leaves = [box for box in root.iter_boxes() if not box.children]
+
+        y = y1
+        while True:
+            top = y
+            for box in leaves:
+                bb = box.dimensions.border_box()
+                if bb.y < y and bb.y + bb.height > y and bb.y < top:
+                    top = bb.y
+            if top == y:
+                return y
+            if top <= y0:
+                # box taller than a page, cut it
+                return y1
+            y = top
+
+    def render_pages (self, ctx, page_height):
+        """ Generator: lay out the document lazily and render it onto ctx one page at a time.
+
+        Pages break at block and line boundaries where possible. After each page is
+        rendered its page number is yielded, the caller is expected to emit it (e.g.
+        surface.show_page()) before resuming. Only the boxes of the current page are
+        kept in memory, so the first page is available before the document is laid
+        out completely. Content pulled above an already emitted page break (e.g. by a
+        negative margin) is not drawn. """
+
+        if page_height <= 0:
+            raise ValueError ('page_height must be positive, got %r' % page_height)
+
+        root, lc = self._stream_root ()
+
+        page   = 0
+        y0     = 0.0
+        bottom = 0.0
+
+        for box in root.layout_stream (lc):
+
+            mb     = box.dimensions.margin_box()
+            bottom = max (bottom, mb.y + mb.height)
+
+            # lay out until a complete page is final
+            while bottom >= y0 + page_height:
+                y1 = self._page_break (root, y0, y0 + page_height)
+                self._render_page (ctx, root, y0, y1)
+                yield page
+                page += 1
+                y0    = y1
+                self._retire_boxes (root, y0)
+
+        while y0 < bottom:
+            y1 = self._page_break (root, y0, y0 + page_height) if y0 + page_height < bottom else bottom
+            self._render_page (ctx, root, y0, y1)
+            yield page
+            page += 1
+            y0    = y1
+
+    def render_viewport (self, ctx, height, offset=0.0):
+        """ Render the part of the document between offset and offset + height onto ctx
+        (translated so offset ends up at y=0).
+
+        Layout stops as soon as the viewport is filled; above the offset, blocks with an
+        explicit height are positioned without laying out their content and completed
+        boxes are released right away. Block extents remembered from earlier calls (until
+        the next mutation) let layout start at the first block reaching into the viewport,
+        so the cost of scrolling depends on what is visible rather than on the offset.
+        Returns the bottom of the laid out part of the document. """
+
+        root, lc = self._stream_root ()
+
+        y1     = offset + height
+        bottom = 0.0
+
+        layout = root.layout_stream (lc, skip_above=offset)
+        for box in layout:
+
+            mb     = box.dimensions.margin_box()
+            bottom = max (bottom, mb.y + mb.height)
+
+            self._retire_boxes (root, offset)
+
+            if bottom >= y1:
+                break
+        layout.close()
+
+        ctx.save()
+        self._render_document_background (ctx, root)
+        ctx.translate (0, -offset)
+        self._render_band (ctx, root, offset, y1)
+        ctx.restore()
+
+        return bottom
+
+    def _render_page (self, ctx, root, y0, y1):
+
+        ctx.save()
+        self._render_document_background (ctx, root)
+        ctx.translate (0, -y0)
+        self._render_band (ctx, root, y0, y1)
+        ctx.restore()
+
+    #
+    # DOM mutation API: changes are applied to the lxml document right away,
+    # layout is updated incrementally on the next relayout() / render()
+    #
+
+    def select (self, selector):
+        """ return list of document nodes matching the given css selector """
+        xpath = cssselect.xpath.HTMLTranslator().css_to_xpath (selector)
+        return self.document.xpath (xpath)
+
+    def set_text (self, node, text):
+        node.text = text
+        self.dirty.append (node)
+        self.stream_marks = {}
+
+    def set_attribute (self, node, key, value):
+        """ set (or remove, if value is None) an attribute, restyles the document """
+        if value is None:
+            if key in node.attrib:
+                del node.attrib[key]
+        else:
+            node.set (key, value)
+        self._restyle ()
+        self.dirty.append (node)
 
-        if VERBOSE:
-            end   = time.clock()
+    def insert_node (self, parent, node, index=None):
+        if index is None:
+            parent.append (node)
+        else:
+            parent.insert (index, node)
+        self._restyle ()
+        self.dirty.append (parent)
 
-            print(repr(root), root.__class__)
-            print(document, repr(document), document.__class__)
-            print(etree.tostring(document.getroot()))
+    def remove_node (self, node):
+        """ remove node (including its tail text) from the document """
+        parent = node.getparent()
+        parent.remove (node)
+        self._restyle ()
+        self.dirty.append (parent)
 
-            print("robinson: %8.3fs tinycss.css21.CSS21Parser()..." % (end-start))
+    def _restyle (self):
+        """ re-match styles, mark every node whose computed style changed as dirty """
+
+        style_map = self._map_styles ()
+
+        self.stream_marks = {}
+
+        for node, style in style_map.items():
+            old_style = self.style_map.get (node)
+            if old_style is None:
+                continue
+            if style_values (old_style) == style_values (style):
+                continue
+
+            # a changed display type affects the parent's box structure
+            if get_style_string (u'display', old_style, 'block') != get_style_string (u'display', style, 'block') \
+               and node.getparent() is not None:
+                self.dirty.append (node.getparent())
+            else:
+                self.dirty.append (node)
+
+        self.style_map = style_map
+
+    def _relayout_root (self, node):
+        """ find the block box that has to be rebuilt when node changes, None if node is not rendered """
+
+        while not node in self.node_boxes:
+            if get_style_string (u'display', self.style_map.get (node, {}), 'block') == 'none':
+                return None
+            node = node.getparent()
+            if node is None:
+                return None
+
+        # only blocks in plain block flow can be laid out on their own:
+        # table cell widths and inline positions depend on their siblings
+
+        path = []
+        box = self.node_boxes[node]
+        while box is not None:
+            path.append (box)
+            box = box.parent
+
+        root = None
+        for box in reversed(path):
+            if box.box_type != 'block':
+                break
+            root = box
+
+        return root if root is not None else path[-1]
+
+    def relayout (self):
+        """ lay out all parts of the tree affected by mutations since the last call """
+
+        if not self.dirty:
+            return
+
+        roots = []
+        for node in self.dirty:
+            box = self._relayout_root (node)
+            if box is not None and not box in roots:
+                roots.append (box)
+        self.dirty = []
+
+        # drop roots which are part of another root's subtree
+        for box in roots[:]:
+            parent = box.parent
+            while parent is not None:
+                if parent in roots:
+                    roots.remove (box)
+                    break
+                parent = parent.parent
+
+        for box in roots:
+            self._relayout_box (box)
+
+        self.index        = None
+        self.stream_marks = {}
+
+    def _forget_boxes (self, box):
+        if box.node is not None and self.node_boxes.get (box.node) is box:
+            del self.node_boxes[box.node]
+        for child in box.children:
+            self._forget_boxes (child)
+
+    def _relayout_box (self, box):
+        """ rebuild + lay out a block box in place, shift everything below it """
+
+        old_mb = box.dimensions.margin_box()
+        parent = box.parent
+
+        self._forget_boxes (box)
+        new_box = self._build_layout_tree (parent, box.node, self.style_map, self.node_boxes)
+
+        if parent is None:
+            lc = LayoutContext (None, self.viewport, 'left')
+            self.ltree = new_box
+        else:
+            parent.children[parent.children.index(box)] = new_box
+            lc = LayoutContext (None, parent.dimensions, 'left')
+            lc.height = old_mb.y - parent.dimensions.content.y
+
+        new_box.layout (lc)
+
+        if self.pool is not None:
+            self.pool.release (box)
+
+        # ancestor subtrees changed structurally
+        ancestor = parent
+        while ancestor is not None:
+            ancestor.sig = None
+            ancestor = ancestor.parent
+
+        # ancestors grow/shrink by the same amount, siblings below are just moved
+
+        delta = new_box.dimensions.margin_box().height - old_mb.height
+        box   = new_box
+        while delta != 0 and box.parent is not None:
+            parent   = box.parent
+            siblings = parent.children
+            for sibling in siblings[siblings.index(box)+1:]:
+                sibling.move (0, delta)
+
+            if parent.style is not None and 'height' in parent.style:
+                break
+            parent.dimensions.content.height += delta
+            box = parent
+
+    def _compile_stylesheet (self, css):
+        """ parse css, return list of (prio, xpath, declarations) tuples in stylesheet order """
 
         cssparser = tinycss.css21.CSS21Parser()
 
         stylesheet = cssparser.parse_stylesheet(css)
-        
-        if VERBOSE:
-            end   = time.clock()
-            print("robinson: %8.3fs style mapping..." % (end-start))
 
-        style_map = {}
+        rules = []
 
         sel_to_xpath = cssselect.xpath.HTMLTranslator().selector_to_xpath
         for rule in stylesheet.rules:
@@ -251,6 +1061,8 @@ class html(object):
 
             #print "CSS Ruleset: %s" % (rule.selector.as_css())
 
+            decls = [(decl.name, Value.from_token(decl.value)) for decl in rule.declarations]
+
             for sel in sels:
                 speci = sel.specificity()
                 prio  = speci2prio (speci)
@@ -259,43 +1071,145 @@ class html(object):
                 xpath = sel_to_xpath (sel)
                 #print "   xpath: %s" % repr(xpath)
 
-                for item in document.xpath(xpath):
-                    #print "     matched item: %s" % repr(item.tag)
+                rules.append ((prio, xpath, decls))
 
-                    if not item in style_map:
-                        style_map[item] = {}
+        return rules
 
-                    for decl in rule.declarations:
-                        #print "       declaration: %s: %s" % (decl.name, decl.value)
+    def _map_styles (self):
+        """ match compiled rules against the document, return node -> {name: (prio, value)} map """
 
-                        if not decl.name in style_map[item]:
-                            style_map[item][decl.name] = (prio, Value.from_token(decl.value))
-                        else:
-                            if prio > style_map[item][decl.name][0]:
-                                style_map[item][decl.name] = (prio, Value.from_token(decl.value))
+        style_map = {}
+
+        for prio, xpath, decls in self.rules:
+
+            if self.deadline is not None:
+                self.deadline.tick()
+
+            for item in self.document.xpath(xpath):
+                #print "     matched item: %s" % repr(item.tag)
+
+                if not item in style_map:
+                    style_map[item] = {}
+
+                for name, value in decls:
+                    #print "       declaration: %s: %s" % (name, value)
+
+                    if not name in style_map[item]:
+                        style_map[item][name] = (prio, value)
+                    else:
+                        if prio > style_map[item][name][0]:
+                            style_map[item][name] = (prio, value)
+
+        return style_map
+
+    def __init__(self, html, css, width, load_resourcefn, text_extents, font_extents, user_data,
+                 layout_cache=None, lazy=False, executor=None, parallel_min_boxes=64, pool=None,
+                 layer_cache=None, image_cache=None, prefetch_workers=0, image_store=None,
+                 stylesheet_cache=None, verbose=False, deadline=None):
+
+        # all state lives in the instance (or in the caches passed in, which are thread
+        # safe), so independent documents can be laid out and rendered in parallel threads
+        self.verbose            = verbose
+        self.lock               = threading.RLock() # guards lazy layout + index building
+        # deadline: robinson.layout.Deadline, checked between phases and periodically during
+        # layout and rendering, raises RenderTimeout / RenderCancelled
+        self.deadline           = deadline
+
+        # executor: concurrent.futures.ThreadPoolExecutor for laying out large sibling
+        # blocks in parallel. Subtrees are laid out in place, so process pools can not be
+        # used. This only pays off on free-threaded Python builds, with the GIL it is
+        # slower than serial layout. text_extents / font_extents must be thread safe.
+        # layer_cache: robinson.layout.LayerCache, subtrees styled '-robinson-layer: cache'
+        # are rasterized once and composited on later render() calls.
+        self.layout_cache       = layout_cache
+        self.layer_cache        = layer_cache
+        # image_cache: robinson.imagecache.ImageCache for decoded images, defaults to
+        # shared_image_cache
+        self.image_cache        = image_cache if image_cache is not None else shared_image_cache
+        # image_store: robinson.imagestore.SharedImageStore sharing decoded images between
+        # processes
+        self.image_store        = image_store
+        # prefetch_workers: if > 0, all resources referenced by src attributes are fetched
+        # concurrently before layout (see prefetch()), load_resourcefn must be thread safe
+        self.pool               = pool
+        if executor is not None:
+            from concurrent.futures import ThreadPoolExecutor
+            if not isinstance (executor, ThreadPoolExecutor):
+                raise ValueError ("html: executor has to be a ThreadPoolExecutor, layout boxes can not be sent to other processes")
+        self.executor           = executor
+        self.parallel_min_boxes = parallel_min_boxes
+        self.text_extents    = text_extents
+        self.font_extents    = font_extents
+        self.load_resourcefn = load_resourcefn
+        self.user_data       = user_data
+
+        if self.verbose:
+            start = time.time()
+            end   = time.time()
+            print("robinson: %8.3fs lxml parsing..." % (end-start))
+
+        root = etree.fromstring(html)
+        document = etree.ElementTree(root)
+
+        if deadline is not None:
+            deadline.check()
+
+        if self.verbose:
+            end   = time.time()
+
+            print(repr(root), root.__class__)
+            print(document, repr(document), document.__class__)
+            print(etree.tostring(document.getroot()))
+
+            print("robinson: %8.3fs tinycss.css21.CSS21Parser()..." % (end-start))
+
+        # stylesheet_cache: dict css -> compiled rules, shared between documents using the
+        # same stylesheets
+        if stylesheet_cache is not None and css in stylesheet_cache:
+            self.rules = stylesheet_cache[css]
+        else:
+            self.rules = self._compile_stylesheet (css)
+            if stylesheet_cache is not None:
+                stylesheet_cache[css] = self.rules
+
+        if self.verbose:
+            end   = time.time()
+            print("robinson: %8.3fs style mapping..." % (end-start))
+
+        self.document  = document
+        self.style_map = self._map_styles ()
+
+        if deadline is not None:
+            deadline.check()
          
         #print "Style map done."
         #print repr(style_map)
 
-        if VERBOSE:
-            end   = time.clock()
+        if self.verbose:
+            end   = time.time()
             print("robinson: %8.3fs building layout tree..." % (end-start))
-            pr.enable()
 
-        viewport = Dimensions ()
-        viewport.content.width  = width
-        self.ltree = self._layout_tree (document.getroot(), style_map, viewport)
+        self.node_boxes = {}
+        self.dirty      = []
+        self.index      = None
 
-        if VERBOSE:
-            end   = time.clock()
-            print("robinson: %8.3fs __init__ done." % (end-start))
+        # streamed layout: node -> where its block children end, see LayoutBox.layout_stream()
+        self.stream_marks = {}
+
+        self.viewport = Dimensions ()
+        self.viewport.content.width  = width
 
-            # pr.disable()
-            # s = StringIO()
-            # sortby = 'cumulative'
-            # ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-            # ps.print_stats()
-            # print s.getvalue()
+        if prefetch_workers > 0:
+            self.prefetch (workers=prefetch_workers)
+
+        # lazy: layout happens on first render(), streaming renderers build their own tree
+        self.ltree = None
+        if not lazy:
+            self.ltree = self._layout_tree (document.getroot(), self.style_map, self.viewport)
+
+        if self.verbose:
+            end   = time.time()
+            print("robinson: %8.3fs __init__ done." % (end-start))
 
         #pprint_ltree (self.ltree, 0)
 
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2016 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# asyncio rendering with deadlines and cancellation (python 3 only)
+#
+
+import asyncio
+import threading
+
+import cairo
+
+from .layout import Deadline, RenderTimeout
+from .output import encode
+
+def _consume (future):
+    # a render abandoned by its caller still finishes (raising RenderCancelled), keep
+    # asyncio from logging its exception as never retrieved
+    if not future.cancelled():
+        future.exception()
+
+async def render_async (html, css, width, load_resourcefn, text_extents, font_extents, user_data,
+                        timeout=None, cancel=None, executor=None, output=None, format='png', **kwargs):
+    """ Parse, lay out and render html in executor (default: the loop's default thread
+    pool), keeping the event loop free. Returns the ARGB32 ImageSurface, encoded to
+    output (file name or file object) in format as well if given. Further keyword
+    arguments are passed on to robinson.html.
+
+    The document is given timeout seconds in total; it is checked between phases and
+    periodically during layout and rendering. Raises robinson.RenderTimeout when it is
+    exceeded and robinson.RenderCancelled once the cancel event (a threading.Event) is
+    set. Cancelling the awaiting task stops the render as well.
+
+    Several renders run concurrently, so text_extents / font_extents must be thread safe,
+    see robinson.TextMetrics. """
+
+    from . import html as Html
+
+    deadline = Deadline (timeout, cancel if cancel is not None else threading.Event())
+
+    def run ():
+
+        doc = Html (html, css, width, load_resourcefn, text_extents, font_extents, user_data,
+                    deadline=deadline, **kwargs)
+
+        w, h    = doc.document_size()
+        surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, int(w), int(h))
+        doc.render (cairo.Context (surface))
+        deadline.check()
+
+        if output is not None:
+            encode (surface, output, format)
+
+        return surface
+
+    loop   = asyncio.get_running_loop()
+    future = loop.run_in_executor (executor, run)
+    future.add_done_callback (_consume)
+
+    try:
+        if timeout is None:
+            return await asyncio.shield (future)
+        return await asyncio.wait_for (asyncio.shield (future), timeout)
+
+    except asyncio.TimeoutError:
+        # the worker notices at its next check
+        deadline.cancel.set()
+        raise RenderTimeout ("render exceeded its time budget")
+
+    except asyncio.CancelledError:
+        deadline.cancel.set()
+        raise
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2016 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# batch rendering of many documents in a pool of worker processes
+#
+
+import os
+
+from io import BytesIO
+
+import cairo
+
+def load_file (fn):
+    with open(fn, 'rb') as f:
+        return f.read()
+
+# per process state of a worker, see _init_worker()
+_worker = {}
+
+def _init_worker (load_resourcefn, stylesheets, images, image_store):
+    """ Set up a worker process: measuring context, compiled stylesheets, fonts they use
+    and preloaded images, all reused by every job the process renders. """
+
+    import robinson
+    from robinson.imagestore import SharedImageStore
+
+    metrics = robinson.TextMetrics()
+
+    _worker['metrics']          = metrics
+    _worker['load_resourcefn']  = load_resourcefn
+    _worker['stylesheet_cache'] = {}
+    _worker['image_cache']      = robinson.ImageCache()
+    _worker['image_store']      = None
+
+    if image_store is not None:
+        _worker['image_store'] = SharedImageStore (image_store)
+
+    # an empty document is enough to compile + cache a stylesheet
+    for css in stylesheets:
+        doc = robinson.html ('<html/>', css, 1, load_resourcefn, metrics.text_extents, metrics.font_extents, None,
+                             lazy=True, stylesheet_cache=_worker['stylesheet_cache'])
+
+        for prio, xpath, decls in _worker['stylesheet_cache'][css]:
+            for name, value in decls:
+                if name == 'font-family' and value.type in ('IDENT', 'STRING'):
+                    metrics.font_extents (None, value.to_str(), 16)
+
+    if images:
+        doc = robinson.html ('<html/>', '', 1, load_resourcefn, metrics.text_extents, metrics.font_extents, None, lazy=True,
+                             image_cache=_worker['image_cache'], image_store=_worker['image_store'])
+        for src in images:
+            doc.load_image (src)
+
+def _render_job (index, job):
+
+    import robinson
+
+    src, css, width, output = job
+
+    metrics = _worker['metrics']
+
+    doc = robinson.html (src, css, width, _worker['load_resourcefn'], metrics.text_extents, metrics.font_extents, None,
+                         image_cache=_worker['image_cache'], image_store=_worker['image_store'],
+                         stylesheet_cache=_worker['stylesheet_cache'])
+
+    if output is None:
+        buf = BytesIO()
+        doc.render_output (buf, 'png')
+        return index, buf.getvalue()
+
+    ext = os.path.splitext (output)[1].lower()[1:]
+
+    if ext == 'pdf':
+        w, h    = doc.document_size()
+        surface = cairo.PDFSurface (output, w, h)
+        ctx     = cairo.Context (surface)
+        doc.render (ctx)
+        surface.show_page()
+        surface.finish()
+    else:
+        doc.render_output (output, ext)
+
+    return index, output
+
+def render_many (jobs, workers=None, ordered=True, load_resourcefn=load_file, images=(), image_store=None):
+    """ Render jobs, (html, css, width, output) tuples, in a pool of workers processes
+    (default: one per core). output is a file name, its extension selects PDF or one of
+    the robinson.output encoders (png, png8, ppm, pgm), or None to get the PNG data back.
+
+    Every worker compiles all stylesheets and loads the fonts they use and the images
+    given once, load_resourcefn must be picklable (a module level function). image_store
+    is a directory for a SharedImageStore used by all workers.
+
+    Generator of (job index, output or PNG data) tuples in job order if ordered, in order
+    of completion otherwise. """
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    jobs        = list(jobs)
+    stylesheets = []
+    for job in jobs:
+        if not job[1] in stylesheets:
+            stylesheets.append (job[1])
+
+    with ProcessPoolExecutor (max_workers=workers, initializer=_init_worker,
+                              initargs=(load_resourcefn, stylesheets, tuple(images), image_store)) as pool:
+
+        futures = [pool.submit (_render_job, i, job) for i, job in enumerate(jobs)]
+
+        if ordered:
+            for future in futures:
+                yield future.result()
+        else:
+            for future in as_completed (futures):
+                yield future.result()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2016 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# display list: flat sequence of draw operations compiled from a laid out
+# LayoutBox tree, replayable onto any number of cairo contexts
+#
+
+import math
+
+import cairo
+
+try:
+    from layout import intersect_rects
+except:
+    from .layout import intersect_rects
+
+class DisplayItem(object):
+    """ A single draw operation.
+
+    kind is one of
+      'paint' : fill the whole target with color
+      'fill'  : fill rects (list of (x, y, w, h)) with color, one path
+      'text'  : show text in font (family, size) with baseline origin x/y
+      'image' : paint surface at x/y
+
+    bbox (x0, y0, x1, y1) covers everything the item draws (None for 'paint'). clip
+    (x0, y0, x1, y1) is set for text and images partially hidden by an overflow: hidden
+    box, fills are clipped geometrically. """
+
+    __slots__ = ('kind', 'color', 'rects', 'font', 'text', 'surface', 'x', 'y', 'bbox', 'clip')
+
+    def __init__(self, kind, color=None, bbox=None):
+        self.kind    = kind
+        self.color   = color
+        self.rects   = None
+        self.font    = None
+        self.text    = None
+        self.surface = None
+        self.x       = 0.0
+        self.y       = 0.0
+        self.bbox    = bbox
+        self.clip    = None
+
+    def __str__(self):
+        return "DisplayItem(%s %s %s)" % (self.kind, repr(self.color), repr(self.bbox))
+
+    def key (self):
+        """ hashable description of what the item draws, equal keys draw equal pixels """
+
+        kind = self.kind
+        if kind == 'fill':
+            return (kind, self.color, tuple(self.rects))
+        if kind == 'text':
+            return (kind, self.color, self.font, self.x, self.y, self.text, self.clip)
+        if kind == 'image':
+            return (kind, id(self.surface), self.x, self.y, self.bbox, self.clip)
+        return (kind, self.color)
+
+class DisplayList(object):
+
+    def __init__(self):
+        self.items = []
+        self.clip  = None # current clip rect while recording, see push_clip()
+        self.clips = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    #
+    # recording
+    #
+
+    def push_clip (self, rect):
+        """ clip everything recorded until the matching pop_clip() to rect (x0, y0, x1, y1) """
+
+        self.clips.append (self.clip)
+        if self.clip is not None:
+            rect = intersect_rects (self.clip, rect)
+        self.clip = rect
+
+    def pop_clip (self):
+        self.clip = self.clips.pop()
+
+    def visible (self, x0, y0, x1, y1):
+        """ False if the rectangle lies completely outside the current clip """
+
+        clip = self.clip
+        if clip is None:
+            return True
+        return x0 < clip[2] and x1 > clip[0] and y0 < clip[3] and y1 > clip[1]
+
+    def _clip_item (self, item):
+        """ apply the current clip to a text or image item, False if nothing is left of it """
+
+        clip = self.clip
+        bbox = item.bbox
+        if bbox[0] >= clip[0] and bbox[1] >= clip[1] and bbox[2] <= clip[2] and bbox[3] <= clip[3]:
+            return True
+
+        bbox = intersect_rects (bbox, clip)
+        if bbox[2] <= bbox[0] or bbox[3] <= bbox[1]:
+            return False
+
+        item.bbox = bbox
+        item.clip = clip
+        return True
+
+    def add_paint (self, color):
+        self.items.append (DisplayItem ('paint', color))
+
+    def add_rect (self, color, x, y, w, h):
+
+        if self.clip is not None:
+            x0, y0, x1, y1 = intersect_rects (self.clip, (x, y, x + w, y + h))
+            x = x0
+            y = y0
+            w = x1 - x0
+            h = y1 - y0
+
+        if w <= 0 or h <= 0:
+            return
+
+        # merge with the previous fill if it uses the same color
+        if self.items:
+            last = self.items[-1]
+            if last.kind == 'fill' and last.color == color:
+                last.rects.append ((x, y, w, h))
+                x0, y0, x1, y1 = last.bbox
+                last.bbox = (min(x0, x), min(y0, y), max(x1, x + w), max(y1, y + h))
+                return
+
+        item = DisplayItem ('fill', color, (x, y, x + w, y + h))
+        item.rects = [(x, y, w, h)]
+        self.items.append (item)
+
+    def add_text (self, color, font, x, y, text, bbox):
+        item = DisplayItem ('text', color, bbox)
+        item.font = font
+        item.x    = x
+        item.y    = y
+        item.text = text
+        if self.clip is not None and not self._clip_item (item):
+            return
+        self.items.append (item)
+
+    def add_image (self, surface, x, y, w, h):
+        item = DisplayItem ('image', None, (x, y, x + w, y + h))
+        item.surface = surface
+        item.x       = x
+        item.y       = y
+        if self.clip is not None and not self._clip_item (item):
+            return
+        self.items.append (item)
+
+    #
+    # playback
+    #
+
+    def replay (self, ctx, clip=None):
+        """ draw all items onto ctx, state changes (color, font) are only issued when needed.
+        If clip (x, y, width, height) is given, items outside of it are skipped (the
+        caller is expected to clip ctx). """
+
+        color = None
+        font  = None
+
+        if clip is not None:
+            cx0 = clip[0]
+            cy0 = clip[1]
+            cx1 = cx0 + clip[2]
+            cy1 = cy0 + clip[3]
+
+        for item in self.items:
+
+            kind = item.kind
+
+            if clip is not None and kind != 'paint':
+                x0, y0, x1, y1 = item.bbox
+                if x1 <= cx0 or x0 >= cx1 or y1 <= cy0 or y0 >= cy1:
+                    continue
+
+            if kind == 'fill':
+                if item.color != color:
+                    color = item.color
+                    ctx.set_source_rgba (color[0], color[1], color[2], 1.0)
+                for r in item.rects:
+                    ctx.rectangle (r[0], r[1], r[2], r[3])
+                ctx.fill ()
+
+            elif kind == 'text':
+                if item.clip is not None:
+                    # source and font are part of the state restored below
+                    c = item.clip
+                    ctx.save ()
+                    ctx.rectangle (c[0], c[1], c[2] - c[0], c[3] - c[1])
+                    ctx.clip ()
+                if item.color != color:
+                    color = item.color
+                    ctx.set_source_rgba (color[0], color[1], color[2], 1.0)
+                if item.font != font:
+                    font = item.font
+                    ctx.select_font_face (font[0])
+                    ctx.set_font_size    (font[1])
+                ctx.move_to   (item.x, item.y)
+                ctx.show_text (item.text)
+                if item.clip is not None:
+                    ctx.restore ()
+                    color = None
+                    font  = None
+
+            elif kind == 'image':
+                # bbox is clipped already
+                x0, y0, x1, y1 = item.bbox
+                ctx.set_source_surface (item.surface, item.x, item.y)
+                ctx.rectangle (x0, y0, x1 - x0, y1 - y0)
+                ctx.fill ()
+                color = None
+
+            elif kind == 'paint':
+                color = item.color
+                ctx.set_source_rgba (color[0], color[1], color[2], 1.0)
+                ctx.paint ()
+
+    #
+    # frame to frame comparison
+    #
+
+    def damage (self, previous, max_rects=8):
+        """ Rectangles (x, y, width, height), snapped to whole pixels, covering everything
+        that differs between previous and this list: bboxes of items that were added or
+        removed. Overlapping rectangles are merged, then the pair wasting the least area
+        is merged until at most max_rects remain. Returns None if the whole target is
+        damaged (no previous frame or a changed document background). """
+
+        if previous is None:
+            return None
+
+        counts = {}
+        for item in self.items:
+            k = item.key()
+            counts[k] = counts.get(k, 0) + 1
+
+        rects = []
+        for item in previous.items:
+            k = item.key()
+            n = counts.get(k, 0)
+            if n:
+                counts[k] = n - 1
+            elif item.kind == 'paint':
+                return None
+            else:
+                rects.append (item.bbox)
+
+        for item in self.items:
+            k = item.key()
+            n = counts.get(k, 0)
+            if not n:
+                continue
+            counts[k] = n - 1
+            if item.kind == 'paint':
+                return None
+            rects.append (item.bbox)
+
+        # pad by a pixel for antialiasing, snap outwards
+        rects = [(int(math.floor(r[0])) - 1, int(math.floor(r[1])) - 1,
+                  int(math.ceil (r[2])) + 1, int(math.ceil (r[3])) + 1) for r in rects]
+
+        rects = merge_rects (rects, max_rects)
+
+        return [(r[0], r[1], r[2] - r[0], r[3] - r[1]) for r in rects]
+
+    #
+    # optimization passes
+    #
+
+    def cull_occluded (self, cell_size=128.0):
+        """ Drop items (and single rectangles of fills) completely covered by a later opaque
+        item: fills and RGB24 images. Coverage is checked against single occluders, areas
+        covered only by the union of several items are kept. Returns the number of items
+        removed. """
+
+        occluders = OccluderGrid (cell_size)
+
+        items   = []
+        removed = 0
+        for item in reversed(self.items):
+
+            kind = item.kind
+
+            if kind == 'fill':
+                rects = [r for r in item.rects if not occluders.covers (r[0], r[1], r[0] + r[2], r[1] + r[3])]
+                if not rects:
+                    removed += 1
+                    continue
+                if len(rects) < len(item.rects):
+                    item.rects = rects
+                    item.bbox  = (min(r[0] for r in rects), min(r[1] for r in rects),
+                                  max(r[0] + r[2] for r in rects), max(r[1] + r[3] for r in rects))
+                for r in rects:
+                    occluders.add (r[0], r[1], r[0] + r[2], r[1] + r[3])
+
+            elif kind == 'text' or kind == 'image':
+                if occluders.covers (*item.bbox):
+                    removed += 1
+                    continue
+                if kind == 'image' and item.surface.get_format() == cairo.FORMAT_RGB24:
+                    occluders.add (*item.bbox)
+
+            items.append (item)
+
+        items.reverse()
+        self.items = items
+
+        return removed
+
+def _union (a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def _area (r):
+    return (r[2] - r[0]) * (r[3] - r[1])
+
+def merge_rects (rects, max_rects, band_factor=4):
+    """ Merge overlapping (x0, y0, x1, y1) rects in one sweep down the page, then reduce
+    them to at most max_rects: by unioning bands of rows when there are more than
+    band_factor * max_rects left, by merging the cheapest pairs otherwise. The result
+    covers all input rects, but may still contain overlaps. """
+
+    max_rects = max(1, max_rects)
+
+    res    = []
+    active = [] # rects that may still overlap the ones further down
+    for r in sorted(rects, key=lambda r: r[1]):
+
+        still = []
+        for o in active:
+            if o[3] < r[1]:
+                res.append (o)
+            elif r[0] <= o[2] and r[2] >= o[0]:
+                r = _union (o, r)
+            else:
+                still.append (o)
+        still.append (r)
+        active = still
+
+    rects = res + active
+
+    if len(rects) > max_rects * band_factor:
+        rects.sort (key=lambda r: r[1])
+        n     = -(-len(rects) // max_rects)
+        bands = []
+        for i in range (0, len(rects), n):
+            band = rects[i]
+            for r in rects[i + 1:i + n]:
+                band = _union (band, r)
+            bands.append (band)
+        rects = bands
+
+    while len(rects) > max_rects:
+        best = None
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                u     = _union (rects[i], rects[j])
+                waste = _area(u) - _area(rects[i]) - _area(rects[j])
+                if best is None or waste < best[0]:
+                    best = (waste, i, j, u)
+        waste, i, j, u = best
+        del rects[j]
+        rects[i] = u
+
+    return rects
+
+class OccluderGrid(object):
+    """ opaque rectangles bucketed into a uniform grid for containment queries """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells     = {}
+
+    def add (self, x0, y0, x1, y1):
+
+        if x1 <= x0 or y1 <= y0:
+            return
+
+        self._register (x0, y0, x1, y1)
+
+        # vertically stacked rects of the same horizontal extent (block siblings) are
+        # merged so they can occlude a common parent background together
+        top    = y0
+        bottom = y1
+        for ox0, oy0, ox1, oy1 in self._cell (x0, y0):
+            if ox0 == x0 and ox1 == x1 and oy1 == y0:
+                top = min(top, oy0)
+        for ox0, oy0, ox1, oy1 in self._cell (x0, y1):
+            if ox0 == x0 and ox1 == x1 and oy0 == y1:
+                bottom = max(bottom, oy1)
+        if top < y0 or bottom > y1:
+            self._register (x0, top, x1, bottom)
+
+    def _cell (self, x, y):
+        cs = self.cell_size
+        return self.cells.get ((int(math.floor(x / cs)), int(math.floor(y / cs))), ())
+
+    def _register (self, x0, y0, x1, y1):
+
+        cs   = self.cell_size
+        rect = (x0, y0, x1, y1)
+        for row in range (int(math.floor(y0 / cs)), int(math.floor(y1 / cs)) + 1):
+            for col in range (int(math.floor(x0 / cs)), int(math.floor(x1 / cs)) + 1):
+                cell = (col, row)
+                if cell in self.cells:
+                    self.cells[cell].append (rect)
+                else:
+                    self.cells[cell] = [rect]
+
+    def covers (self, x0, y0, x1, y1):
+        """ True if a single occluder contains the rectangle """
+
+        # such an occluder has to contain the top left corner, so one cell suffices
+        for ox0, oy0, ox1, oy1 in self._cell (x0, y0):
+            if ox0 <= x0 and oy0 <= y0 and ox1 >= x1 and oy1 >= y1:
+                return True
+        return False
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2016 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# rendering into caller supplied memory (numpy arrays, mmaps, framebuffer
+# memoryviews) and conversion of cairo pixels into display panel formats
+#
+# the conversions need numpy, which is only imported when they are used
+#
+
+import sys
+
+import cairo
+
+def stride_for_width (width, format=cairo.FORMAT_ARGB32):
+    """ row stride in bytes cairo requires for a buffer of the given width and format """
+    return cairo.ImageSurface.format_stride_for_width (format, width)
+
+def surface_for_buffer (buf, width, height, stride=None, format=cairo.FORMAT_ARGB32):
+    """ ImageSurface drawing directly into buf (any writable buffer of at least
+    stride * height bytes), no copy is made. Call finish() on the surface once done. """
+
+    if stride is None:
+        stride = stride_for_width (width, format)
+
+    return cairo.ImageSurface.create_for_data (buf, format, width, height, stride)
+
+def pixel_view (buf, width, height, stride):
+    """ (height, width, 4) uint8 view of ARGB32 / RGB24 pixels as B, G, R, A channels """
+
+    import numpy as np
+
+    if stride is None:
+        stride = stride_for_width (width)
+
+    a = np.frombuffer (buf, dtype=np.uint8, count=stride * height).reshape (height, stride)
+    a = a[:, :width * 4].reshape (height, width, 4)
+
+    # cairo stores pixels as native endian 32 bit words
+    if sys.byteorder == 'big':
+        a = a[:, :, ::-1]
+
+    return a
+
+def to_rgb565 (buf, width, height, stride=None, out=None, swap_bytes=False):
+    """ Convert ARGB32 / RGB24 pixels in buf to RGB565, returns a (height, width) uint16
+    array. If out is given (for example a numpy view of a framebuffer mmap), the result
+    is written there. swap_bytes produces the big endian order most SPI panels expect. """
+
+    import numpy as np
+
+    px = pixel_view (buf, width, height, stride)
+
+    if out is None:
+        out = np.empty ((height, width), dtype=np.uint16)
+
+    r = px[:, :, 2].astype (np.uint16)
+    g = px[:, :, 1].astype (np.uint16)
+    b = px[:, :, 0].astype (np.uint16)
+
+    np.left_shift (np.right_shift (r, 3), 11, out=r)
+    np.left_shift (np.right_shift (g, 2),  5, out=g)
+    np.right_shift (b, 3, out=b)
+    np.bitwise_or (r, g, out=r)
+    np.bitwise_or (r, b, out=out)
+
+    if swap_bytes:
+        out.byteswap (True)
+
+    return out
+
+def to_gray8 (buf, width, height, stride=None, out=None):
+    """ Convert ARGB32 / RGB24 pixels in buf to 8 bit luminance (ITU-R BT.601 weights),
+    returns a (height, width) uint8 array, written to out if given. """
+
+    import numpy as np
+
+    px = pixel_view (buf, width, height, stride)
+
+    if out is None:
+        out = np.empty ((height, width), dtype=np.uint8)
+
+    y = px[:, :, 2].astype (np.uint16) * 77
+    y += px[:, :, 1].astype (np.uint16) * 150
+    y += px[:, :, 0].astype (np.uint16) * 29
+    np.right_shift (y, 8, out=y)
+    out[...] = y
+
+    return out
+
+def to_mono1 (buf, width, height, stride=None, out=None, threshold=128, invert=False):
+    """ Convert ARGB32 / RGB24 pixels in buf to 1 bit per pixel, rows packed MSB first and
+    padded to whole bytes, returns a (height, (width + 7) // 8) uint8 array, written to
+    out if given. Pixels with a luminance >= threshold are set (cleared if invert). """
+
+    import numpy as np
+
+    gray = to_gray8 (buf, width, height, stride)
+
+    if invert:
+        bits = gray < threshold
+    else:
+        bits = gray >= threshold
+
+    packed = np.packbits (bits, axis=1)
+
+    if out is None:
+        return packed
+
+    out[...] = packed
+    return out
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2016 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# bounded, thread safe cache of decoded images
+#
+
+import struct
+import threading
+
+from collections import OrderedDict
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def png_size (data):
+    """ (width, height) from the IHDR chunk of PNG data, None if data is not a PNG """
+
+    if data is None or len(data) < 24 or data[:8] != PNG_SIGNATURE or data[12:16] != b'IHDR':
+        return None
+
+    return struct.unpack ('>II', data[16:24])
+
+class ImageCache(object):
+    """ Decoded ImageSurfaces keyed by resource name.
+
+    The memory used by the cached surfaces (stride * height) is kept below max_bytes by
+    evicting the least recently used ones; a single surface larger than the budget is
+    still returned but not kept. Pass one instance to several html objects to share
+    decoded images between them, or a private one per document.
+
+    Besides decoded surfaces the cache holds raw (still encoded) resource data, counted
+    against the same budget and evicted first, and the dimensions of images probed
+    from their headers, so layout does not have to decode images. """
+
+    def __init__(self, max_bytes=64*1024*1024, max_sizes=4096):
+        self.entries   = OrderedDict() # key -> (surface, nbytes)
+        self.raw       = OrderedDict() # key -> encoded data
+        self.sizes     = OrderedDict() # key -> (width, height)
+        self.max_sizes = max_sizes
+        self.max_bytes = max_bytes
+        self.size      = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.lock      = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get (self, key, loader=None):
+        """ Cached surface for key. On a miss, loader(key) is called (outside of the lock,
+        so concurrent misses decode in parallel) and its result is stored; without a
+        loader None is returned. """
+
+        with self.lock:
+            entry = self.entries.pop (key, None)
+            if entry is not None:
+                self.entries[key] = entry # most recently used
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        if loader is None:
+            return None
+
+        return self.put (key, loader (key))
+
+    def put (self, key, surface):
+        """ store surface, returns the cached surface for key (an earlier one wins) """
+
+        nbytes = surface.get_stride() * surface.get_height()
+
+        with self.lock:
+            # the encoded data is not needed anymore
+            data = self.raw.pop (key, None)
+            if data is not None:
+                self.size -= len(data)
+
+            entry = self.entries.get (key)
+            if entry is not None:
+                return entry[0]
+
+            if nbytes > self.max_bytes:
+                return surface
+
+            self.entries[key] = (surface, nbytes)
+            self.size += nbytes
+
+            self._evict()
+
+        return surface
+
+    def _evict (self):
+
+        while self.size > self.max_bytes and self.raw:
+            k, data = self.raw.popitem (last=False)
+            self.size      -= len(data)
+            self.evictions += 1
+
+        while self.size > self.max_bytes:
+            k, (s, n) = self.entries.popitem (last=False)
+            self.size      -= n
+            self.evictions += 1
+
+    #
+    # encoded data + dimensions
+    #
+
+    def get_raw (self, key):
+        with self.lock:
+            return self.raw.get (key)
+
+    def pop_raw (self, key):
+        with self.lock:
+            data = self.raw.pop (key, None)
+            if data is not None:
+                self.size -= len(data)
+            return data
+
+    def put_raw (self, key, data):
+        """ keep encoded data for key until it is decoded (see put()) or evicted """
+
+        with self.lock:
+            if key in self.entries or key in self.raw or len(data) > self.max_bytes:
+                return
+            self.raw[key] = data
+            self.size += len(data)
+            self._evict()
+
+    def size_of (self, key):
+        """ (width, height) of a decoded or probed image, None if unknown """
+
+        with self.lock:
+            entry = self.entries.get (key)
+            if entry is not None:
+                return entry[0].get_width(), entry[0].get_height()
+            return self.sizes.get (key)
+
+    def set_size (self, key, size):
+        with self.lock:
+            self.sizes[key] = size
+            if len(self.sizes) > self.max_sizes:
+                self.sizes.popitem (last=False)
+
+    def clear (self):
+        with self.lock:
+            self.entries.clear()
+            self.raw.clear()
+            self.sizes.clear()
+            self.size = 0
+
+    def stats (self):
+        """ dict with hits, misses, evictions, entries and bytes """
+
+        with self.lock:
+            return {'hits'      : self.hits,
+                    'misses'    : self.misses,
+                    'evictions' : self.evictions,
+                    'entries'   : len(self.entries),
+                    'bytes'     : self.size}
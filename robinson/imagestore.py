@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2016 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# decoded images shared between processes through memory mapped files
+#
+
+import os
+import mmap
+import struct
+import hashlib
+import tempfile
+import threading
+import traceback
+
+import cairo
+
+class SharedImageStore(object):
+    """ Decoded images as memory mapped files in directory, keyed by the SHA1 of the
+    encoded data.
+
+    Each file starts with a HEADER_SIZE bytes header (magic, cairo format, width, height,
+    stride) followed by the raw (premultiplied) cairo pixels. Processes using the same
+    directory decode every image only once per host and map the same pages instead of
+    holding private copies. Files are written atomically (rename), so concurrent
+    writers are harmless. """
+
+    HEADER      = struct.Struct ('<4sIIII')
+    HEADER_SIZE = 64 # keeps the pixel rows aligned
+    MAGIC       = b'RBI1'
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.hits      = 0
+        self.misses    = 0
+        self.lock      = threading.Lock()
+
+        if not os.path.isdir (directory):
+            try:
+                os.makedirs (directory)
+            except OSError:
+                # created concurrently
+                if not os.path.isdir (directory):
+                    raise
+
+    def path (self, key):
+        return os.path.join (self.directory, key + '.argb')
+
+    def load (self, data, decode):
+        """ surface for the encoded image data, mapped from the store or decode(data)'d
+        and added to it """
+
+        key = hashlib.sha1 (data).hexdigest()
+
+        surface = self._map (key)
+        with self.lock:
+            if surface is not None:
+                self.hits += 1
+                return surface
+            self.misses += 1
+
+        surface = decode (data)
+        self._write (key, surface)
+
+        mapped = self._map (key)
+        if mapped is not None:
+            return mapped
+        return surface
+
+    def _map (self, key):
+
+        try:
+            f = open (self.path (key), 'rb')
+        except (IOError, OSError):
+            return None
+
+        with f:
+            size = os.fstat (f.fileno()).st_size
+            if size < SharedImageStore.HEADER_SIZE:
+                return None
+            # copy on write: pages stay shared as long as nobody draws into the surface
+            mm = mmap.mmap (f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        magic, format, width, height, stride = SharedImageStore.HEADER.unpack_from (mm, 0)
+
+        start = SharedImageStore.HEADER_SIZE
+        end   = start + stride * height
+        if magic != SharedImageStore.MAGIC or size < end:
+            mm.close()
+            return None
+
+        # the surface keeps the buffer and with it the mapping alive
+        return cairo.ImageSurface.create_for_data (memoryview (mm)[start:end], format, width, height, stride)
+
+    def _write (self, key, surface):
+
+        surface.flush()
+
+        width  = surface.get_width()
+        height = surface.get_height()
+        stride = surface.get_stride()
+
+        header = SharedImageStore.HEADER.pack (SharedImageStore.MAGIC, int(surface.get_format()), width, height, stride)
+
+        fd, tmpfn = tempfile.mkstemp (dir=self.directory, prefix='.' + key)
+        try:
+            with os.fdopen (fd, 'wb') as f:
+                f.write (header.ljust (SharedImageStore.HEADER_SIZE, b'\0'))
+                f.write (surface.get_data()[:stride * height])
+            if hasattr (os, 'replace'):
+                os.replace (tmpfn, self.path (key))
+            else:
+                os.rename (tmpfn, self.path (key))
+        except:
+            # rendering goes on with the privately decoded surface
+            traceback.print_exc()
+            if os.path.exists (tmpfn):
+                os.remove (tmpfn)
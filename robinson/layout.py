@@ -18,9 +18,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import re, os
+import re, os, math
+import time
+import bisect
+import threading
+
+import cairo
 
 from functools import reduce
+from collections import OrderedDict
 
 try:
     from colors import css_colors_low
@@ -28,9 +34,46 @@ except:
     from .colors import css_colors_low
 
 try:
-    from style import Value, zero
+    from style import zero, auto, align_left, style_values
 except:
-    from .style import Value, zero
+    from .style import zero, auto, align_left, style_values
+
+def intersect_rects (a, b):
+    """ intersection of two (x0, y0, x1, y1) rects, empty results have x1 == x0 or y1 == y0 """
+    x0 = max(a[0], b[0])
+    y0 = max(a[1], b[1])
+    return (x0, y0, max(x0, min(a[2], b[2])), max(y0, min(a[3], b[3])))
+
+class RenderTimeout(Exception):
+    """ the time budget of a Deadline was exceeded """
+    pass
+
+class RenderCancelled(Exception):
+    """ the cancel event of a Deadline was set """
+    pass
+
+class Deadline(object):
+    """ Time budget (timeout in seconds, None for no limit) and cancel event (a
+    threading.Event) for a document. html checks it between phases, layout and render
+    loops call tick(), which checks every interval calls. """
+
+    def __init__(self, timeout=None, cancel=None, interval=64):
+        self.expires  = time.time() + timeout if timeout is not None else None
+        self.cancel   = cancel if cancel is not None else threading.Event()
+        self.interval = interval
+        self.count    = 0
+
+    def check (self):
+        if self.cancel.is_set():
+            raise RenderCancelled ("render cancelled")
+        if self.expires is not None and time.time() > self.expires:
+            raise RenderTimeout ("render exceeded its time budget")
+
+    def tick (self):
+        self.count += 1
+        if self.count >= self.interval:
+            self.count = 0
+            self.check()
 
 class Rect(object):
 
@@ -69,6 +112,20 @@ class Dimensions(object):
         self.border  = EdgeSizes()
         self.margin  = EdgeSizes()
 
+    def reset(self):
+        c = self.content
+        c.x = c.y = c.width = c.height = 0.0
+        for e in (self.padding, self.border, self.margin):
+            e.left = e.right = e.top = e.bottom = 0.0
+
+    def margin_width(self):
+        """ margin_box().width without creating intermediate rects """
+        return self.content.width + self.padding.left + self.padding.right + self.border.left + self.border.right + self.margin.left + self.margin.right
+
+    def margin_height(self):
+        """ margin_box().height without creating intermediate rects """
+        return self.content.height + self.padding.top + self.padding.bottom + self.border.top + self.border.bottom + self.margin.top + self.margin.bottom
+
     def padding_box(self):
         """ The area covered by the content area plus its padding. """
         return self.content.expanded_by(self.padding)
@@ -85,6 +142,11 @@ class LayoutContext(object):
 
     def __init__(self, parent, containing_block_dim, text_alignment):
 
+        self.line           = []
+        self.init (parent, containing_block_dim, text_alignment)
+
+    def init(self, parent, containing_block_dim, text_alignment):
+
         self.parent         = parent
 
         self.containing_block_dim = containing_block_dim
@@ -92,7 +154,7 @@ class LayoutContext(object):
         self.height         = 0 
 
         # current line box
-        self.line           = [] # for inline boxes
+        del self.line[:]         # for inline boxes
         self.line_width     = 0  # used for table rows as well as inline boxes
         self.line_height    = 0
         self.text_alignment = text_alignment
@@ -102,9 +164,17 @@ class LayoutContext(object):
         self.table_colw_sum = 0
         self.table_coli     = 0
         self.table_colf     = 1.0 # column width scaling factor
+        self.table_fixed    = False # table-layout: fixed, colw is taken from the first row
+
+        # child layouts may be handed to html.executor (not inside worker tasks)
+        self.parallel       = parent.parallel if parent is not None else True
+
+        # bottom of the nearest overflow: hidden ancestor's clip rect, content starting
+        # below it is not laid out (see LayoutBox.clip_bottom())
+        self.clip_bottom    = parent.clip_bottom if parent is not None else None
 
     def get_table_context(self):
-        if self.table_colw:
+        if self.table_colw is not None:
             return self
         return self.parent.get_table_context()
 
@@ -126,25 +196,297 @@ class LayoutContext(object):
 
         # wrap to next line 
         self.height      += self.line_height
-        self.line         = [] # for inline boxes
+        del self.line[:]       # for inline boxes
         self.line_width   = 0
         self.line_height  = 0
 
+class Signature(object):
+    """ Structure of a laid out subtree as nested tuples, see LayoutBox.signature(). The
+    hash is computed once, equality compares the whole structure, so colliding hashes
+    never make two different subtrees share cache entries. """
+
+    __slots__ = ('parts', 'hash')
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.hash  = hash (parts) # children are Signatures with their hash cached
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return self is other or (isinstance (other, Signature) and self.hash == other.hash and self.parts == other.parts)
+
+    def __ne__(self, other):
+        return not self.__eq__ (other)
+
+class LayoutCache(object):
+    """ Memoizes the geometry of laid out subtrees relative to their containing block.
+
+    Entries are keyed by the structure of the subtree (box types, text, images and
+    computed styles) and its box count, the inherited styles layout depends on and the
+    available width, so repeated structures (table cells, list rows) only get laid out
+    once. A cache can be shared between html instances. """
+
+    # inherited properties that influence geometry
+    INHERITED = ('font-family', 'font-size', 'text-align')
+
+    def __init__(self, max_entries=4096, max_boxes=256):
+        self.entries     = OrderedDict()
+        self.max_entries = max_entries
+        self.max_boxes   = max_boxes # larger subtrees are unlikely to repeat
+        self.hits        = 0
+        self.misses      = 0
+        self.lock        = threading.Lock()
+
+    def key (self, box, lc):
+        sig, size = box.signature()
+        if size > self.max_boxes:
+            return None
+        inherited = tuple(box.get_style (k, None, None, inherit=True) for k in LayoutCache.INHERITED)
+        return (sig, size, inherited, lc.containing_block_dim.content.width)
+
+    def restore (self, key, box, lc):
+        """ apply cached geometry to box, return False on cache miss """
+
+        with self.lock:
+            geometry = self.entries.get (key)
+            if geometry is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+
+        ox = lc.containing_block_dim.content.x
+        oy = lc.containing_block_dim.content.y + lc.height
+
+        for b, g in zip (box.iter_boxes(), geometry):
+            x, y, w, h, padding, border, margin, img, clipped = g
+            d = b.dimensions
+            d.content.x      = ox + x
+            d.content.y      = oy + y
+            d.content.width  = w
+            d.content.height = h
+            d.padding.left, d.padding.right, d.padding.top, d.padding.bottom = padding
+            d.border.left,  d.border.right,  d.border.top,  d.border.bottom  = border
+            d.margin.left,  d.margin.right,  d.margin.top,  d.margin.bottom  = margin
+            b.img     = img
+            b.clipped = clipped
+
+        lc.height = lc.height + box.dimensions.margin_box().height
+        return True
+
+    def store (self, key, box, oy, lc):
+        """ remember geometry of freshly laid out box, oy is the y offset it was laid out at """
+
+        ox = lc.containing_block_dim.content.x
+        oy = lc.containing_block_dim.content.y + oy
+
+        geometry = []
+        for b in box.iter_boxes():
+            d = b.dimensions
+            geometry.append ((d.content.x - ox, d.content.y - oy, d.content.width, d.content.height,
+                              (d.padding.left, d.padding.right, d.padding.top, d.padding.bottom),
+                              (d.border.left,  d.border.right,  d.border.top,  d.border.bottom),
+                              (d.margin.left,  d.margin.right,  d.margin.top,  d.margin.bottom),
+                              b.img, b.clipped))
+
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                self.entries.popitem (last=False)
+            self.entries[key] = geometry
+
+class LayerCache(object):
+    """ Rasterized subtrees of boxes styled '-robinson-layer: cache'.
+
+    The first render of such a subtree draws it into an offscreen surface, later renders
+    composite that surface with a single paint. Entries are keyed by the subtree's
+    structure, the inherited styles rendering depends on, the geometry of all its
+    boxes and the subpixel offset on the target, so any change to styles, text or
+    geometry simply misses the cache. Least recently used layers are dropped once
+    max_bytes is exceeded. A cache can be shared between html instances. """
+
+    # inherited properties that influence rendering
+    INHERITED = ('color', 'font-family', 'font-size')
+
+    # extra pixels around the subtree's border boxes for glyph overhang + antialiasing
+    PAD = 2.0
+
+    def __init__(self, max_bytes=32*1024*1024):
+        self.entries   = OrderedDict()
+        self.max_bytes = max_bytes
+        self.size      = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.lock      = threading.Lock()
+
+    def key (self, box):
+        """ (key, extents) for box's subtree, extents (x0, y0, x1, y1) cover all its border boxes """
+
+        sig, size = box.signature()
+        inherited = tuple(box.get_style (k, None, None, inherit=True) for k in LayerCache.INHERITED)
+
+        bb = box.dimensions.border_box()
+        x0 = bb.x
+        y0 = bb.y
+        x1 = bb.x + bb.width
+        y1 = bb.y + bb.height
+
+        geometry = []
+        for b in box.iter_boxes():
+            r = b.dimensions.border_box()
+            geometry.append ((r.x - bb.x, r.y - bb.y, r.width, r.height))
+            x0 = min(x0, r.x)
+            y0 = min(y0, r.y)
+            x1 = max(x1, r.x + r.width)
+            y1 = max(y1, r.y + r.height)
+
+        return (sig, inherited, tuple(geometry)), (x0, y0, x1, y1)
+
+    def render (self, box, ctx):
+        """ paint box and its descendants from a cached layer, returns False if ctx is
+        scaled or rotated (layers are rasterized at device resolution) """
+
+        xx, yx, xy, yy, tx, ty = ctx.get_matrix()
+        if xx != 1.0 or yy != 1.0 or xy != 0.0 or yx != 0.0:
+            return False
+
+        key, extents = self.key (box)
+
+        # align the layer to device pixels, remember the fractional offset in the key
+        x0 = extents[0] - LayerCache.PAD
+        y0 = extents[1] - LayerCache.PAD
+        fx = (x0 + tx) - math.floor(x0 + tx)
+        fy = (y0 + ty) - math.floor(y0 + ty)
+        ox = x0 - fx
+        oy = y0 - fy
+        key = key + (fx, fy)
+
+        layer = None
+        with self.lock:
+            entry = self.entries.pop (key, None)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries[key] = entry # most recently used
+                layer = entry[0]
+
+        if layer is None:
+            w = int(math.ceil(extents[2] + LayerCache.PAD - ox))
+            h = int(math.ceil(extents[3] + LayerCache.PAD - oy))
+
+            layer = ctx.get_target().create_similar (cairo.CONTENT_COLOR_ALPHA, w, h)
+            lctx  = cairo.Context (layer)
+            lctx.translate (-ox, -oy)
+            box.render (lctx, layers=False)
+
+            self.store (key, layer, w * h * 4)
+
+        ctx.set_source_surface (layer, ox, oy)
+        ctx.paint ()
+
+        return True
+
+    def store (self, key, layer, nbytes):
+
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (layer, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                k, (l, n) = self.entries.popitem (last=False)
+                self.size -= n
+
+class LayoutPool(object):
+    """ Free lists of LayoutBox, LayoutContext and Dimensions objects.
+
+    Passing the same pool to consecutive html instances and calling html.release() when
+    done with one lets continuous re-rendering reuse these objects instead of allocating
+    (and garbage collecting) new ones every frame. """
+
+    def __init__(self, max_size=65536):
+        self.boxes      = []
+        self.contexts   = []
+        self.dimensions = []
+        self.max_size   = max_size
+        self.lock       = threading.Lock() # parallel layout allocates from several threads
+
+    def box (self, html, parent, box_type, node, style, text=None):
+        with self.lock:
+            box = self.boxes.pop() if self.boxes else None
+        if box is None:
+            return LayoutBox (html, parent, box_type, node, style, text)
+        box.init (html, parent, box_type, node, style, text)
+        return box
+
+    def context (self, parent, containing_block_dim, text_alignment):
+        with self.lock:
+            lc = self.contexts.pop() if self.contexts else None
+        if lc is None:
+            return LayoutContext (parent, containing_block_dim, text_alignment)
+        lc.init (parent, containing_block_dim, text_alignment)
+        return lc
+
+    def dim (self):
+        with self.lock:
+            d = self.dimensions.pop() if self.dimensions else None
+        if d is None:
+            return Dimensions ()
+        d.reset()
+        return d
+
+    def release (self, box):
+        """ return box and all its descendants to the pool """
+
+        released = []
+        stack    = [box]
+        while stack:
+            b = stack.pop()
+            stack.extend (b.children)
+            del b.children[:]
+            b.html = b.parent = b.node = b.style = b.img = None
+            released.append (b)
+
+        with self.lock:
+            self.boxes.extend (released[:max(self.max_size - len(self.boxes), 0)])
+
+    def release_context (self, lc):
+        lc.parent = lc.containing_block_dim = None
+        with self.lock:
+            if len(self.contexts) < self.max_size:
+                self.contexts.append (lc)
+
+    def release_dim (self, d):
+        with self.lock:
+            if len(self.dimensions) < self.max_size:
+                self.dimensions.append (d)
+
 class LayoutBox(object):
 
     def __init__(self, html, parent, box_type, node, style, text=None):
 
+        self.dimensions = Dimensions ()
+        self.children   = []
+        self.init (html, parent, box_type, node, style, text)
+
+    def init(self, html, parent, box_type, node, style, text=None):
+
         #print "Creating LayoutBox of type %s, node %s" % (box_type, node)
 
-        self.dimensions = Dimensions ()
+        self.dimensions.reset()
         self.html       = html
         self.parent     = parent
         self.box_type   = box_type
-        self.children   = []
         self.node       = node
         self.style      = style
         self.text       = text 
         self.img        = None
+        self.sig        = None # (Signature, box count), see signature()
+        self.lazy       = False # children are built on demand, see html._iter_child_boxes()
+        self.last_block = None  # lazy boxes: node of the last block child built
+        self.open       = False # streamed layout of this box is still in progress
+        self.clipped    = False # not laid out, hidden by an overflow: hidden parent, see layout_clipped()
 
     def __str__(self):
 
@@ -159,6 +501,24 @@ class LayoutBox(object):
         for child in self.children:
             child.move (xoffset, yoffset)
 
+    def iter_boxes (self):
+        """ this box and all its descendants in document order """
+        yield self
+        for child in self.children:
+            for box in child.iter_boxes():
+                yield box
+
+    def signature (self):
+        """ (Signature, box count) of this subtree: box types, text, images and computed styles """
+
+        if self.sig is None:
+            style = frozenset (style_values (self.style).items()) if self.style else None
+            src   = (self.node.get ('src'), self.node.get ('width'), self.node.get ('height')) if self.box_type == 'img' else None
+            child_sigs = [child.signature() for child in self.children]
+            self.sig = (Signature ((self.box_type, self.text, style, src, tuple(cs[0] for cs in child_sigs))),
+                        1 + sum (cs[1] for cs in child_sigs))
+        return self.sig
+
     def get_style (self, key, fallback_key, default, inherit=False):
 
         if not self.style:
@@ -194,18 +554,52 @@ class LayoutBox(object):
         # Otherwise, create a new one.
 
         if len(self.children)==0 or self.children[-1].box_type != 'anonymous':
-            self.children.append(LayoutBox(self.html, self, 'anonymous', None, None))
+            self.children.append(self.html.new_box(self, 'anonymous', None, None))
 
         return self.children[-1]
 
+    def is_memoizable (self):
+        """ geometry of this subtree depends on its containing block width only """
+
+        if self.box_type == 'td':
+            return True
+        if self.box_type != 'block' and self.box_type != 'anonymous' and self.box_type != 'table':
+            return False
+        # table sections depend on the column widths of the whole table
+        return self.parent is None or self.parent.box_type != 'table'
+
+    def layout_memoized (self, lc, layout_fn):
+        """ run layout_fn(lc) unless the html's layout cache has geometry for this subtree """
+
+        cache = self.html.layout_cache
+        # below a clipping ancestor the geometry depends on the position of the subtree
+        if cache is None or lc.clip_bottom is not None or not self.is_memoizable():
+            layout_fn (lc)
+            return
+
+        key = cache.key (self, lc)
+        if key is None:
+            layout_fn (lc)
+            return
+
+        if cache.restore (key, self, lc):
+            return
+
+        oy = lc.height
+        layout_fn (lc)
+        cache.store (key, self, oy, lc)
+
     def layout(self, lc):
         """Lay out a box and its descendants."""
+        if self.html.deadline is not None:
+            self.html.deadline.tick()
+
         if self.box_type == 'block' or self.box_type == 'anonymous':
-            self.layout_block(lc)
+            self.layout_memoized(lc, self.layout_block)
         elif self.box_type == 'inline' :
             self.layout_inline(lc)
         elif self.box_type == 'table' :
-            self.layout_table(lc)
+            self.layout_memoized(lc, self.layout_table)
         elif self.box_type == 'tr' :
             self.layout_table_row(lc)
         elif self.box_type == 'td' :
@@ -228,9 +622,9 @@ class LayoutBox(object):
         self.calculate_inline_position(lc)
 
         # adjust line height
-        mb = self.dimensions.margin_box()
-        if lc.line_height < mb.height:
-            lc.line_height = mb.height
+        mh = self.dimensions.margin_height()
+        if lc.line_height < mh:
+            lc.line_height = mh
 
     def calculate_image_width_height(self):
         # margin, border, and padding have initial value 0.
@@ -252,10 +646,9 @@ class LayoutBox(object):
 
         # get image size
 
-        imagefn  = self.node.get('src')
-        self.img = self.html.load_image(imagefn)
-        width    = self.img.get_width()
-        height   = self.img.get_height()
+        # read from the image header, pixels are only decoded once rendered (see image())
+        iw, ih = self.html.image_size (self.node.get('src'))
+        width, height = self.image_target_size (iw, ih)
 
         d = self.dimensions
         d.content.width  = width
@@ -276,11 +669,133 @@ class LayoutBox(object):
         d.margin.top = margin_top.to_px()
         d.margin.bottom = margin_bottom.to_px()
 
+    def is_fixed_table (self):
+        return self.box_type == 'table' and \
+               self.get_style ('table-layout', None, auto).to_str() == 'fixed'
+
+    def is_streamable (self):
+        """ containers whose children can be laid out (and released) one at a time """
+        return self.box_type == 'block' or self.is_fixed_table()
+
+    def layout_stream (self, lc, skip_above=None):
+        """Generator variant of layout(): streamable containers are laid out child by child.
+
+        Every box is yielded right after its layout is complete, containers after their
+        last child, so everything above the bottom of a yielded box's margin box is final.
+
+        Blocks with an explicit height which end above skip_above are only positioned,
+        their descendants are not laid out at all. Lazily built blocks record where their
+        block children end (html.stream_marks) when skip_above is given, later calls
+        resume at the last block ending above skip_above without building the ones
+        before it."""
+
+        if not self.is_streamable():
+            self.layout (lc)
+            yield self
+            return
+
+        if self.box_type == 'table':
+            self.init_fixed_table (lc)
+
+        self.calculate_block_width(lc)
+        self.calculate_block_position(lc)
+
+        if skip_above is not None and self.style is not None and 'height' in self.style:
+            d = self.dimensions
+            d.content.height = self.get_style("height", None, None).to_px()
+            mb = d.margin_box()
+            if mb.y + mb.height <= skip_above:
+                self.children = []
+                lc.height = lc.height + mb.height
+                yield self
+                return
+
+        self.open = True
+
+        align = self.get_style("text-align", None, align_left, inherit=True)
+
+        clc = LayoutContext(lc, self.dimensions, align.to_str())
+
+        # (width, [bottom of a block child relative to content.y], [its node]), only
+        # kept for viewport rendering, streamed renders keep their memory bounded
+        marks = None
+        after = None
+        if skip_above is not None and self.lazy and self.box_type == 'block':
+            d     = self.dimensions
+            marks = self.html.stream_marks.get (self.node)
+            if marks is None or marks[0] != d.content.width:
+                marks = (d.content.width, [], [])
+            i = bisect.bisect_right (marks[1], skip_above - d.content.y) - 1
+            if i >= 0:
+                clc.height = marks[1][i]
+                after      = marks[2][i]
+
+        for child in self.html._iter_child_boxes (self, after):
+            for box in child.layout_stream (clc, skip_above):
+                yield box
+            # bottoms only grow, blocks recorded before are not added twice
+            if marks is not None and child.node is not None and (not marks[1] or clc.height > marks[1][-1]):
+                if not marks[1]:
+                    self.html.stream_marks[self.node] = marks
+                marks[1].append (clc.height)
+                marks[2].append (self.last_block)
+
+        clc.line_wrap()
+
+        self.calculate_block_height(clc)
+        lc.height = lc.height + self.dimensions.margin_box().height
+
+        self.open = False
+        yield self
+
+    def init_fixed_table (self, lc):
+        # column widths are determined by the first row (see layout_table_row)
+        lc.table_colw     = []
+        lc.table_colw_sum = 0
+        lc.table_fixed    = True
+
+    def fixed_column_widths (self):
+        """table-layout: fixed column widths of a (first) table row.
+
+        Cells with a specified width keep it (plus their horizontal edges), the remaining
+        width of the row is split evenly between the others."""
+
+        colw      = []
+        auto_cols = 0
+        for td in self.children:
+            width = td.get_style ('width', None, auto)
+            if width.is_auto():
+                colw.append (None)
+                auto_cols += 1
+                continue
+
+            w = width.to_px()
+            for key, fallback_key in (("margin-left", "margin"), ("margin-right", "margin"),
+                                      ("border-left-width", "border-width"), ("border-right-width", "border-width"),
+                                      ("padding-left", "padding"), ("padding-right", "padding")):
+                w += td.get_style (key, fallback_key, zero).to_px()
+            colw.append (w)
+
+        if auto_cols > 0:
+            fixed_sum = sum (w for w in colw if w is not None)
+            w = max (self.dimensions.content.width - fixed_sum, 0.0) / auto_cols
+            colw = [w if cw is None else cw for cw in colw]
+
+        return colw
+
     def layout_table (self, lc):
         """ Very simple table layout support at this point. """
 
         d = self.dimensions
-        align = self.get_style("text-align", None, Value ('IDENT', 'left'), inherit=True)
+        align = self.get_style("text-align", None, align_left, inherit=True)
+
+        if self.is_fixed_table():
+            # no measuring pass, rows are laid out in a single pass
+            self.init_fixed_table (lc)
+            self.layout_block(lc)
+            return
+
+        lc.table_fixed = False
 
         #
         # ask children about their widths to determine column widths 
@@ -298,10 +813,10 @@ class LayoutBox(object):
 
                     td.calculate_inline_width_height()
 
-                    mb = td.dimensions.margin_box()
+                    mw = td.dimensions.margin_width()
 
-                    if mb.width > lc.table_colw[col_i]:
-                        lc.table_colw[col_i] = mb.width
+                    if mw > lc.table_colw[col_i]:
+                        lc.table_colw[col_i] = mw
                     col_i += 1
 
         lc.table_colw_sum = reduce (lambda x, y: x+y, lc.table_colw, 0.0)
@@ -332,27 +847,35 @@ class LayoutBox(object):
 
         # import pdb; pdb.set_trace()
 
-        tlc.table_colf = self.dimensions.content.width / tlc.table_colw_sum
+        if tlc.table_fixed:
+            if not tlc.table_colw:
+                tlc.table_colw     = self.fixed_column_widths()
+                tlc.table_colw_sum = sum (tlc.table_colw)
+            # fixed column widths are used as they are
+            tlc.table_colf = 1.0
+        else:
+            tlc.table_colf = self.dimensions.content.width / tlc.table_colw_sum
 
         # Determine where the box is located within its container.
         self.calculate_block_position(lc)
 
         # Recursively lay out the children of this box.
         clc = self.layout_block_children(lc)
+        self.html.release_context(clc)
 
         # our content height := max(child.content.height)
         h = 0
         for child in self.children:
-            ch = child.dimensions.margin_box().height
+            ch = child.dimensions.margin_height()
             if ch > h:
                 h = ch
         self.dimensions.content.height = h
         # make all cells of this row equal height:
         for child in self.children:
-            child.dimensions.content.height += h - child.dimensions.margin_box().height
+            child.dimensions.content.height += h - child.dimensions.margin_height()
 
         # Increment the container's height so each child is laid out below the previous one.
-        lc.height = lc.height + self.dimensions.margin_box().height
+        lc.height = lc.height + self.dimensions.margin_height()
 
 
     def layout_table_cell (self, lc):
@@ -361,7 +884,7 @@ class LayoutBox(object):
         # we're basically doing block layout here, but within a fake context
         # tailored to our place in the table
 
-        align = self.get_style("text-align", None, Value ('IDENT', 'left'), inherit=True)
+        align = self.get_style("text-align", None, align_left, inherit=True)
 
         # fake dimensions for this table cell
 
@@ -369,20 +892,27 @@ class LayoutBox(object):
 
         d = lc.containing_block_dim
 
-        fake_dim = Dimensions()
+        fake_dim = self.html.new_dim()
         fake_dim.content.x      = d.content.x + tlc.line_width
         fake_dim.content.y      = d.content.y + lc.height
 
-        w = tlc.table_colw[tlc.table_coli] * tlc.table_colf
+        if tlc.table_coli < len(tlc.table_colw):
+            w = tlc.table_colw[tlc.table_coli] * tlc.table_colf
+        else:
+            # table-layout: fixed rows may have more cells than the first one
+            w = 0.0
 
         fake_dim.content.width  = w
         fake_dim.content.height = 0
 
         #print "layout_table_cell: fake_dim.content: %s" % fake_dim.content
 
-        fake_lc = LayoutContext(lc, fake_dim, align.to_str())
+        fake_lc = self.html.new_context(lc, fake_dim, align.to_str())
 
-        self.layout_block(fake_lc)
+        self.layout_memoized(fake_lc, self.layout_block)
+
+        self.html.release_context(fake_lc)
+        self.html.release_dim(fake_dim)
         
         tlc.line_width += w
         tlc.table_coli += 1
@@ -400,12 +930,14 @@ class LayoutBox(object):
         self.calculate_inline_position(lc)
 
         # Recursively lay out the children of this box.
-        self.layout_inline_children(lc)
+        # (leaf boxes, i.e. words, have nothing to lay out: skip the line box setup)
+        if self.children:
+            self.layout_inline_children(lc)
 
         # adjust line height
-        mb = self.dimensions.margin_box()
-        if lc.line_height < mb.height:
-            lc.line_height = mb.height
+        mh = self.dimensions.margin_height()
+        if lc.line_height < mh:
+            lc.line_height = mh
 
         #print "layout_inline done: %s %s" % (self, lc)
 
@@ -442,7 +974,8 @@ class LayoutBox(object):
             width  = 0
             height = 0
 
-        width = self.get_style("width", "width", Value('DIMENSION', width, 'px')).to_px()
+        w = self.get_style("width", "width", None)
+        width = w.to_px() if w is not None else float(width)
 
         # make room for children, if any
 
@@ -452,12 +985,13 @@ class LayoutBox(object):
             else:
                 child.calculate_inline_width_height()
 
-            cb = child.dimensions.margin_box()
+            cw = child.dimensions.margin_width()
+            ch = child.dimensions.margin_height()
 
-            if cb.width > width:
-                width = cb.width
-            if cb.height > height:
-                height = cb.height
+            if cw > width:
+                width = cw
+            if ch > height:
+                height = ch
 
         d = self.dimensions
         d.content.width  = width
@@ -511,11 +1045,15 @@ class LayoutBox(object):
         #print "   d.margin : %s" % d.margin 
 
     def layout_inline_children(self, lc):
-        align = self.get_style("text-align", None, Value ('IDENT', 'left'), inherit=True)
+        align = self.get_style("text-align", None, align_left, inherit=True)
 
-        clc = LayoutContext(lc, self.dimensions, align.to_str())
+        clc = self.html.new_context(lc, self.dimensions, align.to_str())
+        clip_bottom = clc.clip_bottom
         for child in self.children:
-            child.layout(clc)
+            if clip_bottom is not None and clc.containing_block_dim.content.y + clc.height >= clip_bottom:
+                child.layout_clipped(clc)
+            else:
+                child.layout(clc)
 
         # finish + align last line
         clc.line_wrap()
@@ -523,6 +1061,8 @@ class LayoutBox(object):
         if clc.height > self.dimensions.content.height:
             self.dimensions.content.height = clc.height
 
+        self.html.release_context(clc)
+
 
     def layout_block (self, lc):
         """Lay out a block-level element and its descendants."""
@@ -540,10 +1080,11 @@ class LayoutBox(object):
         # Parent height can depend on child height, so `calculate_height` must be called after the
         # children are laid out.
         self.calculate_block_height(clc)
+        self.html.release_context(clc)
     
         # Increment the height so each child is laid out below the previous one.
-        #print "layout_block: %s complete height is %f, lc is %s" % (self, self.dimensions.margin_box().height, id(lc))
-        lc.height = lc.height + self.dimensions.margin_box().height
+        #print "layout_block: %s complete height is %f, lc is %s" % (self, self.dimensions.margin_height(), id(lc))
+        lc.height = lc.height + self.dimensions.margin_height()
 
     def calculate_block_width(self, lc):
         """Calculate the width of a block-level non-replaced element in normal flow."""     
@@ -553,13 +1094,10 @@ class LayoutBox(object):
         #print "calculate_block_width: %s" % (self)
 
         # `width` has initial value `auto`.
-        auto = Value('IDENT', 'auto')
         width = self.get_style ('width', None, auto)
 
         # margin, border, and padding have initial value 0.
 
-        zero = Value ('DIMENSION', 0.0, 'px')
-
         margin_left = self.get_style("margin-left", "margin", zero)
         margin_right = self.get_style("margin-right", "margin", zero)
 
@@ -569,22 +1107,30 @@ class LayoutBox(object):
         padding_left = self.get_style("padding-left", "padding", zero)
         padding_right = self.get_style("padding-right", "padding", zero)
 
+        # work on plain floats from here on (auto values count as 0),
+        # this runs for every block so avoid creating Value objects
+
+        width_auto        = width.is_auto()
+        margin_left_auto  = margin_left.is_auto()
+        margin_right_auto = margin_right.is_auto()
+
+        w  = 0.0 if width_auto else width.to_px()
+        ml = 0.0 if margin_left_auto else margin_left.to_px()
+        mr = 0.0 if margin_right_auto else margin_right.to_px()
 
-        total = reduce(lambda x, y: x+y, 
-                           map(lambda x: 0.0 if x.is_auto() else x.to_px(), 
-                               [margin_left, margin_right, border_left, border_right,
-                                padding_left, padding_right, width]))
+        bl = border_left.to_px()
+        br = border_right.to_px()
+        pl = padding_left.to_px()
+        pr = padding_right.to_px()
+
+        total = ml + mr + bl + br + pl + pr + w
 
         #print "   margin: %s, %s;\n   border: %s, %s;\n   padding: %s, %s;\n   total: %s" % (margin_left, margin_right, border_left, border_right, padding_left, padding_right, total)
  
         # If width is not auto and the total is wider than the container, treat auto margins as 0.
-        if not width.is_auto() and total > lc.containing_block_dim.content.width:
-            if margin_left.is_auto():
-                margin_left = zero
-            
-            if margin_right.is_auto():
-                margin_right = zero
-            
+        if not width_auto and total > lc.containing_block_dim.content.width:
+            margin_left_auto  = False
+            margin_right_auto = False
 
         # Adjust used values so that the above sum equals `lc.containing_block_dim.width`.
         # Each arm of the `match` should increase the total width by exactly `underflow`,
@@ -594,47 +1140,42 @@ class LayoutBox(object):
         #print "   underflow: %f" % underflow
 
         # If the values are overconstrained, calculate margin_right.
-        if not width.is_auto() and not margin_left.is_auto() and not margin_right.is_auto():
-            margin_right = Value.length(margin_right.to_px() + underflow, 'px')
+        if not width_auto and not margin_left_auto and not margin_right_auto:
+            mr = mr + underflow
 
         # If exactly one size is auto, its used value follows from the equality.
-        elif not width.is_auto() and not margin_left.is_auto() and margin_right.is_auto():
-            margin_right = Value.length(underflow, 'px')
-        elif not width.is_auto() and margin_left.is_auto() and not margin_right.is_auto():
-            margin_right = Value.length(underflow, 'px')
+        elif not width_auto and not margin_left_auto and margin_right_auto:
+            mr = underflow
+        elif not width_auto and margin_left_auto and not margin_right_auto:
+            mr = underflow
 
         # If width is set to auto, any other auto values become 0.
-        elif width.is_auto() :
-            if margin_left.is_auto():
-                margin_left = Value.length(0.0, 'px')
-            if margin_right.is_auto():
-                margin_right = Value.length(0.0, 'px')
-
+        elif width_auto :
             if underflow >= 0.0:
                 # Expand width to fill the underflow.
-                width = Value.length(underflow, 'px')
+                w = underflow
             else:
                 # Width can't be negative. Adjust the right margin instead.
-                width = Value.length(0.0, 'px')
-                margin_right = Value.length(margin_right.to_px() + underflow, 'px')
+                w = 0.0
+                mr = mr + underflow
 
         # If margin-left and margin-right are both auto, their used values are equal.
-        elif not width.is_auto() and margin_left.is_auto() and margin_right.is_auto():
-            margin_left = Value.length(underflow / 2.0, 'px');
-            margin_right = Value.length(underflow / 2.0, 'px');
+        elif not width_auto and margin_left_auto and margin_right_auto:
+            ml = underflow / 2.0
+            mr = underflow / 2.0
 
 
         d = self.dimensions
-        d.content.width = width.to_px()
+        d.content.width = w
 
-        d.padding.left = padding_left.to_px()
-        d.padding.right = padding_right.to_px()
+        d.padding.left = pl
+        d.padding.right = pr
 
-        d.border.left = border_left.to_px()
-        d.border.right = border_right.to_px()
+        d.border.left = bl
+        d.border.right = br
 
-        d.margin.left = margin_left.to_px()
-        d.margin.right = margin_right.to_px()
+        d.margin.left = ml
+        d.margin.right = mr
 
         #print "   d.content: %s" % d.content
         #print "   d.padding: %s" % d.padding
@@ -651,9 +1192,6 @@ class LayoutBox(object):
 
         d = self.dimensions
 
-        # margin, border, and padding have initial value 0.
-        zero = Value ('DIMENSION', 0.0, 'px')
-
         # If margin-top or margin-bottom is `auto`, the used value is zero.
         d.margin.top = self.get_style("margin-top", "margin", zero).to_px()
         d.margin.bottom = self.get_style("margin-bottom", "margin", zero).to_px()
@@ -676,17 +1214,114 @@ class LayoutBox(object):
 
     def layout_block_children(self, lc):
 
-        align = self.get_style("text-align", None, Value ('IDENT', 'left'), inherit=True)
+        align = self.get_style("text-align", None, align_left, inherit=True)
 
-        clc = LayoutContext(lc, self.dimensions, align.to_str())
-        for child in self.children:
-            child.layout(clc)
+        clc = self.html.new_context(lc, self.dimensions, align.to_str())
+
+        # line boxes of inline children are cut as well, once a line starts below the clip
+        clip_bottom = self.clip_bottom()
+        if clip_bottom is not None and (clc.clip_bottom is None or clip_bottom < clc.clip_bottom):
+            clc.clip_bottom = clip_bottom
+        clip_bottom = clc.clip_bottom
+
+        if self.html.executor is not None and clc.parallel and clip_bottom is None and self.can_layout_children_detached():
+            self.layout_children_parallel(clc)
+        else:
+            for child in self.children:
+                if clip_bottom is not None and clc.containing_block_dim.content.y + clc.height >= clip_bottom:
+                    child.layout_clipped(clc)
+                else:
+                    child.layout(clc)
 
         # finish + align last line
         clc.line_wrap()
 
         return clc
 
+    def is_clipping (self):
+        """ True if this box clips its descendants to its padding box (overflow: hidden) """
+
+        if not self.style or not 'overflow' in self.style:
+            return False
+        value = self.style['overflow'][1]
+        return value.type == 'IDENT' and value.value == 'hidden'
+
+    def clip_bottom (self):
+        """ bottom of the clip rect of a block whose height is known before its children
+        are laid out (overflow: hidden + explicit height), None otherwise """
+
+        if not self.is_clipping() or not 'height' in self.style:
+            return None
+
+        d = self.dimensions
+        return d.content.y + self.get_style("height", None, None).to_px() + d.padding.bottom
+
+    def clip_rect (self, clip=None):
+        """ (x0, y0, x1, y1) padding box of this box, intersected with clip """
+
+        pb   = self.dimensions.padding_box()
+        rect = (pb.x, pb.y, pb.x + pb.width, pb.y + pb.height)
+        if clip is None:
+            return rect
+        return intersect_rects (rect, clip)
+
+    def layout_clipped (self, lc):
+        """ Position a box starting below the clip rect of an ancestor without laying out
+        (or measuring) its content: it cannot be visible. """
+
+        d = self.dimensions
+        d.reset()
+        d.content.x = lc.containing_block_dim.content.x
+        d.content.y = lc.containing_block_dim.content.y + lc.height
+
+        self.clipped = True
+
+    def can_layout_children_detached (self):
+        """ children whose layout only depends on the width of this box, at least two of them large """
+
+        large = 0
+        for child in self.children:
+            if child.box_type != 'block' and child.box_type != 'anonymous' and child.box_type != 'table':
+                return False
+            if child.signature()[1] >= self.html.parallel_min_boxes:
+                large += 1
+
+        return large >= 2
+
+    def layout_detached (self, lc):
+        """ lay out this block-level box at y=0 of a private copy of lc's containing block """
+
+        cb = Dimensions()
+        cb.content.x     = lc.containing_block_dim.content.x
+        cb.content.width = lc.containing_block_dim.content.width
+
+        dlc = LayoutContext(lc, cb, lc.text_alignment)
+        dlc.parallel = False
+
+        self.layout(dlc)
+
+    def layout_children_parallel (self, clc):
+        """ Block children are laid out independently at y=0, large ones in html.executor,
+        then stacked below each other. """
+
+        futures = []
+        for child in self.children:
+            if child.signature()[1] >= self.html.parallel_min_boxes:
+                futures.append (self.html.executor.submit (child.layout_detached, clc))
+            else:
+                futures.append (None)
+
+        for child, future in zip(self.children, futures):
+            if future is None:
+                child.layout_detached (clc)
+
+        # offset pass
+        for child, future in zip(self.children, futures):
+            if future is not None:
+                future.result()
+            child.move (0, clc.containing_block_dim.content.y + clc.height)
+            clc.height = clc.height + child.dimensions.margin_box().height
+
     def calculate_block_height(self, lc):
         """Height of a block-level non-replaced element in normal flow with overflow visible."""
 
@@ -698,16 +1333,58 @@ class LayoutBox(object):
         else:
             self.dimensions.content.height = lc.height + lc.line_height
 
-    def render (self, ctx):
+    def is_layer (self):
+        """ True if this subtree should be rendered through the layer cache """
+
+        if not self.style or not '-robinson-layer' in self.style:
+            return False
+        value = self.style['-robinson-layer'][1]
+        return value.type == 'IDENT' and value.value == 'cache'
+
+    def render (self, ctx, layers=True, clip=None):
+        """ render this box and its descendants, clip (x0, y0, x1, y1) is the clip rect of
+        overflow: hidden ancestors, boxes outside of it are skipped """
+
+        if self.html.deadline is not None:
+            self.html.deadline.tick()
+
+        if layers and self.html.layer_cache is not None and self.is_layer():
+            if self.html.layer_cache.render (self, ctx):
+                return
+
+        if clip is None or self.intersects (clip):
+            self.render_box(ctx)
+
+        if not self.is_clipping():
+            for child in self.children:
+                if not child.clipped:
+                    child.render (ctx, clip=clip)
+            return
+
+        clip = self.clip_rect (clip)
+
+        ctx.save()
+        ctx.rectangle (clip[0], clip[1], clip[2] - clip[0], clip[3] - clip[1])
+        ctx.clip()
+        for child in self.children:
+            if not child.clipped:
+                child.render (ctx, clip=clip)
+        ctx.restore()
+
+    def intersects (self, clip):
+        """ True if the border box of this box intersects clip (x0, y0, x1, y1) """
+
+        bb = self.dimensions.border_box()
+        return bb.x < clip[2] and bb.x + bb.width > clip[0] and bb.y < clip[3] and bb.y + bb.height > clip[1]
+
+    def render_box (self, ctx):
+        """ render this box only, not its descendants """
 
         self.render_background(ctx)
         self.render_borders(ctx)
         self.render_text(ctx)
         self.render_image(ctx)
 
-        for child in self.children:
-            child.render (ctx)
-
     def render_background (self, ctx):
 
         color = self.get_color ('background')
@@ -777,14 +1454,153 @@ class LayoutBox(object):
         ctx.move_to           (self.dimensions.content.x, self.dimensions.content.y + xt[0])
         ctx.show_text         (self.text)
 
+    def image_target_size (self, iw, ih):
+        """ used size of an iw x ih image: CSS width / height, else the width / height
+        attributes; if only one of them is given the aspect ratio is kept """
+
+        w = self.image_dimension ('width')
+        h = self.image_dimension ('height')
+
+        if w is None and h is None:
+            return iw, ih
+        if w is None:
+            w = float(iw) * h / ih if ih else 0.0
+        if h is None:
+            h = float(ih) * w / iw if iw else 0.0
+
+        return w, h
+
+    def image_dimension (self, name):
+
+        value = self.get_style (name, None, auto)
+        if value.type == 'INTEGER' or value.type == 'NUMBER' or value.type == 'DIMENSION':
+            return value.to_px()
+
+        attr = self.node.get (name)
+        if attr is not None:
+            m = re.match (r'^\s*([0-9]+(\.[0-9]*)?)\s*(px)?\s*$', attr)
+            if m:
+                return float(m.group(1))
+
+        return None
+
+    def image_filter (self):
+        """ cairo filter used for scaling this image (CSS image-rendering) """
+
+        value = self.get_style ('image-rendering', None, None, inherit=True)
+        if value is not None and value.type == 'IDENT' and value.value in ('pixelated', 'crisp-edges', 'optimizeSpeed'):
+            return cairo.FILTER_NEAREST
+        return cairo.FILTER_GOOD
+
+    def image (self):
+        """ decoded image of an img box, scaled to its content size, loaded on first use """
+
+        if self.img is not None:
+            return self.img
+
+        src = self.node.get('src')
+        d   = self.dimensions
+        w   = max(int(round(d.content.width)),  1)
+        h   = max(int(round(d.content.height)), 1)
+
+        if (w, h) == self.html.image_size (src):
+            self.img = self.html.load_image (src)
+        else:
+            self.img = self.html.load_scaled_image (src, w, h, self.image_filter())
+
+        return self.img
+
     def render_image (self, ctx):
        
-        if not self.img:
+        if self.box_type != 'img':
             return
 
         d = self.dimensions
 
-        ctx.set_source_surface(self.img, d.content.x, d.content.y)
-        ctx.rectangle (d.content.x, d.content.y, self.img.get_width(), self.img.get_height())
+        # don't decode images outside of the clip area (if the context can tell)
+        if hasattr (ctx, 'clip_extents'):
+            x0, y0, x1, y1 = ctx.clip_extents()
+            if d.content.x >= x1 or d.content.y >= y1 or d.content.x + d.content.width <= x0 or d.content.y + d.content.height <= y0:
+                return
+
+        img = self.image()
+
+        ctx.set_source_surface(img, d.content.x, d.content.y)
+        ctx.rectangle (d.content.x, d.content.y, img.get_width(), img.get_height())
         ctx.fill ()
 
+
+    #
+    # display list compilation, mirrors render() (see displaylist.py)
+    #
+
+    def compile (self, dl):
+
+        self.compile_background(dl)
+        self.compile_borders(dl)
+        self.compile_text(dl)
+        self.compile_image(dl)
+
+        if not self.is_clipping():
+            for child in self.children:
+                if not child.clipped:
+                    child.compile (dl)
+            return
+
+        dl.push_clip (self.clip_rect())
+        for child in self.children:
+            if not child.clipped:
+                child.compile (dl)
+        dl.pop_clip ()
+
+    def compile_background (self, dl):
+
+        color = self.get_color ('background')
+        if color is None:
+            return
+
+        rect = self.dimensions.border_box()
+        dl.add_rect (color, rect.x, rect.y, rect.width, rect.height)
+
+    def compile_borders (self, dl):
+
+        color = self.get_color ('border-color')
+        if color is None:
+            return
+
+        d = self.dimensions
+        border_box = d.border_box()
+
+        dl.add_rect (color, border_box.x, border_box.y, d.border.left, border_box.height)
+        dl.add_rect (color, border_box.x + border_box.width - d.border.right, border_box.y, d.border.right, border_box.height)
+        dl.add_rect (color, border_box.x, border_box.y, border_box.width, d.border.top)
+        dl.add_rect (color, border_box.x, border_box.y + border_box.height - d.border.bottom, border_box.width, d.border.bottom)
+
+    def compile_text (self, dl):
+
+        if not self.text:
+            return
+
+        color = self.get_color ('color', inherit=True)
+        if color is None:
+            return
+
+        font_family = self.get_style("font-family", None, "Monospace", inherit=True).to_str()
+        font_size   = self.get_style("font-size", None, 16, inherit=True).to_px()
+
+        c  = self.dimensions.content
+        xt = self.html.font_extents(self.html.user_data, font_family, font_size)
+        dl.add_text (color, (font_family, font_size), c.x, c.y + xt[0], self.text,
+                     (c.x, c.y, c.x + c.width, c.y + c.height))
+
+    def compile_image (self, dl):
+
+        if self.box_type != 'img':
+            return
+
+        d = self.dimensions
+        if not dl.visible (d.content.x, d.content.y, d.content.x + d.content.width, d.content.y + d.content.height):
+            return
+
+        img = self.image()
+        dl.add_image (img, d.content.x, d.content.y, img.get_width(), img.get_height())
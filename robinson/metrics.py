@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2016 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# thread safe text measuring
+#
+
+import threading
+
+from collections import OrderedDict
+
+import cairo
+
+class TextMetrics(object):
+    """ text_extents / font_extents callbacks for html() which can be used from any number
+    of threads at once: every thread measures on a cairo context of its own (user_data
+    is ignored), results are memoized in a locked cache of at most max_entries.
+
+        metrics = TextMetrics()
+        doc = robinson.html (html, css, width, load_resourcefn,
+                             metrics.text_extents, metrics.font_extents, None)
+    """
+
+    def __init__(self, max_entries=65536):
+        self.local       = threading.local()
+        self.entries     = OrderedDict()
+        self.max_entries = max_entries
+        self.lock        = threading.Lock()
+
+    def _ctx (self):
+        ctx = getattr (self.local, 'ctx', None)
+        if ctx is None:
+            ctx = cairo.Context (cairo.ImageSurface (cairo.FORMAT_ARGB32, 1, 1))
+            self.local.ctx = ctx
+        return ctx
+
+    def _measure (self, key, fn):
+
+        with self.lock:
+            res = self.entries.get (key)
+            if res is not None:
+                return res
+
+        ctx = self._ctx()
+        ctx.select_font_face (key[1])
+        ctx.set_font_size (key[2])
+        res = tuple(fn (ctx))
+
+        with self.lock:
+            self.entries[key] = res
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem (last=False)
+
+        return res
+
+    def text_extents (self, user_data, font_face, font_size, text):
+        return self._measure (('t', font_face, font_size, text), lambda ctx: ctx.text_extents (text))
+
+    def font_extents (self, user_data, font_face, font_size):
+        return self._measure (('f', font_face, font_size), lambda ctx: ctx.font_extents ())
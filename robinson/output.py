@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2016 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# encoders for rendered ImageSurfaces: PNG with selectable zlib level, paletted
+# PNG, binary PPM / PGM. All of them stream rows to any file-like object,
+# FrameEncoder runs them on a background thread.
+#
+# pixel conversion needs numpy, which is only imported when encoding
+#
+
+import struct
+import threading
+import zlib
+
+try:
+    from queue import Queue
+except:
+    from Queue import Queue
+
+import cairo
+
+try:
+    from framebuffer import pixel_view, to_gray8
+except:
+    from .framebuffer import pixel_view, to_gray8
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# rows converted + written at a time
+BAND_ROWS = 64
+
+def _chunk (f, ctype, data):
+    f.write (struct.pack ('>I', len(data)))
+    f.write (ctype)
+    f.write (data)
+    f.write (struct.pack ('>I', zlib.crc32 (data, zlib.crc32 (ctype)) & 0xffffffff))
+
+def _rows (surface, y0, y1):
+    """ (rows, width, channels) uint8 RGB or RGBA (ARGB32 surfaces, unpremultiplied) pixels """
+
+    import numpy as np
+
+    surface.flush()
+
+    w  = surface.get_width()
+    h  = surface.get_height()
+    px = pixel_view (surface.get_data(), w, h, surface.get_stride())[y0:y1]
+
+    if surface.get_format() != cairo.FORMAT_ARGB32:
+        return px[:, :, 2::-1]
+
+    rgba = np.empty (px.shape, dtype=np.uint8)
+    a    = px[:, :, 3].astype (np.uint16)
+    nz   = np.maximum (a, 1)
+    for c in range(3):
+        rgba[:, :, c] = np.minimum ((px[:, :, 2 - c].astype (np.uint16) * 255 + a // 2) // nz, 255)
+    rgba[:, :, 3] = px[:, :, 3]
+
+    return rgba
+
+def _write_png (f, width, height, color_type, bit_depth, bands, level, extra_chunks=()):
+    """ write a PNG, bands yields byte strings of packed rows (without filter bytes) """
+
+    f.write (PNG_SIGNATURE)
+    _chunk (f, b'IHDR', struct.pack ('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0))
+    for ctype, data in extra_chunks:
+        _chunk (f, ctype, data)
+
+    z = zlib.compressobj (level)
+    for rows, row_bytes in bands:
+        # filter type 0 (none) in front of every row
+        data = b''.join (b'\x00' + rows[i:i + row_bytes] for i in range (0, len(rows), row_bytes))
+        data = z.compress (data)
+        if data:
+            _chunk (f, b'IDAT', data)
+    _chunk (f, b'IDAT', z.flush())
+
+    _chunk (f, b'IEND', b'')
+
+def write_png (surface, f, level=6):
+    """ Encode surface as 8 bit RGB (RGB24) or RGBA (ARGB32) PNG into file-like f.
+    level is the zlib compression level: 0 (stored, fastest) .. 9 (smallest). """
+
+    import numpy as np
+
+    w = surface.get_width()
+    h = surface.get_height()
+    channels = 4 if surface.get_format() == cairo.FORMAT_ARGB32 else 3
+
+    def bands():
+        for y in range (0, h, BAND_ROWS):
+            rows = np.ascontiguousarray (_rows (surface, y, min(y + BAND_ROWS, h)))
+            yield rows.tobytes(), w * channels
+
+    _write_png (f, w, h, 6 if channels == 4 else 2, 8, bands(), level)
+
+def write_png_paletted (surface, f, level=6, max_colors=256):
+    """ Encode surface as paletted PNG into file-like f, using the smallest bit depth
+    (1, 2, 4 or 8) that holds its colors. Raises ValueError if the surface has more than
+    max_colors (at most 256) distinct colors. """
+
+    import numpy as np
+
+    w = surface.get_width()
+    h = surface.get_height()
+
+    px = _rows (surface, 0, h)
+    if px.shape[2] == 3:
+        keys = (px[:, :, 0].astype (np.uint32) << 24) | (px[:, :, 1].astype (np.uint32) << 16) | \
+               (px[:, :, 2].astype (np.uint32) << 8) | 0xff
+    else:
+        keys = (px[:, :, 0].astype (np.uint32) << 24) | (px[:, :, 1].astype (np.uint32) << 16) | \
+               (px[:, :, 2].astype (np.uint32) << 8) | px[:, :, 3].astype (np.uint32)
+
+    palette, indices = np.unique (keys, return_inverse=True)
+    if len(palette) > min(max_colors, 256):
+        raise ValueError ("write_png_paletted: %d colors exceed max_colors (%d)" % (len(palette), max_colors))
+    indices = indices.reshape (h, w).astype (np.uint8)
+
+    depth = 8
+    for d in (1, 2, 4):
+        if len(palette) <= (1 << d):
+            depth = d
+            break
+
+    plte = np.empty ((len(palette), 3), dtype=np.uint8)
+    plte[:, 0] = palette >> 24
+    plte[:, 1] = (palette >> 16) & 0xff
+    plte[:, 2] = (palette >> 8) & 0xff
+    chunks = [(b'PLTE', plte.tobytes())]
+
+    alpha = (palette & 0xff).astype (np.uint8)
+    if (alpha < 255).any():
+        chunks.append ((b'tRNS', alpha.tobytes()))
+
+    # pack pixels MSB first, rows padded to whole bytes
+    ppb = 8 // depth
+    if ppb > 1:
+        wb     = (w + ppb - 1) // ppb
+        padded = np.zeros ((h, wb * ppb), dtype=np.uint8)
+        padded[:, :w] = indices
+        shifts  = np.arange (8 - depth, -1, -depth, dtype=np.uint8)
+        indices = np.bitwise_or.reduce (padded.reshape (h, wb, ppb) << shifts, axis=2).astype (np.uint8)
+    row_bytes = indices.shape[1]
+
+    def bands():
+        for y in range (0, h, BAND_ROWS):
+            yield np.ascontiguousarray (indices[y:y + BAND_ROWS]).tobytes(), row_bytes
+
+    _write_png (f, w, h, 3, depth, bands(), level, chunks)
+
+def write_ppm (surface, f):
+    """ Encode surface as binary PPM (P6) into file-like f, alpha is dropped """
+
+    import numpy as np
+
+    w = surface.get_width()
+    h = surface.get_height()
+
+    f.write (b'P6\n%d %d\n255\n' % (w, h))
+    for y in range (0, h, BAND_ROWS):
+        rows = _rows (surface, y, min(y + BAND_ROWS, h))[:, :, :3]
+        f.write (np.ascontiguousarray (rows).tobytes())
+
+def write_pgm (surface, f):
+    """ Encode surface as binary 8 bit grayscale PGM (P5) into file-like f """
+
+    surface.flush()
+
+    w = surface.get_width()
+    h = surface.get_height()
+
+    gray = to_gray8 (surface.get_data(), w, h, surface.get_stride())
+
+    f.write (b'P5\n%d %d\n255\n' % (w, h))
+    for y in range (0, h, BAND_ROWS):
+        f.write (gray[y:y + BAND_ROWS].tobytes())
+
+# the encoders read 32 bit pixels
+SURFACE_FORMATS = (cairo.FORMAT_ARGB32, cairo.FORMAT_RGB24)
+
+ENCODERS = {
+    'png'  : write_png,
+    'png8' : write_png_paletted,
+    'ppm'  : write_ppm,
+    'pgm'  : write_pgm,
+}
+
+def encode (surface, f, format='png', **options):
+    """ Encode surface into f (file-like object or file name) using one of the
+    ENCODERS: 'png' (option level), 'png8' (paletted, options level, max_colors),
+    'ppm' or 'pgm'. The surface has to be one of SURFACE_FORMATS (ARGB32, RGB24). """
+
+    if not format in ENCODERS:
+        raise ValueError ("encode: unknown format %s" % format)
+
+    if not surface.get_format() in SURFACE_FORMATS:
+        raise ValueError ("encode: unsupported surface format %s, use ARGB32 or RGB24" % surface.get_format())
+
+    if isinstance (f, str):
+        with open (f, 'wb') as fo:
+            ENCODERS[format] (surface, fo, **options)
+    else:
+        ENCODERS[format] (surface, f, **options)
+
+class FrameEncoder(object):
+    """ Encodes frames on a background thread so the next frame can be laid out and
+    rendered meanwhile. At most max_pending frames are queued, submit() blocks beyond
+    that. A submitted surface must not be drawn to until close() returns. Errors raised
+    by the encoder are re-raised from the next submit() or close(). """
+
+    def __init__(self, format='png', max_pending=2, **options):
+
+        if not format in ENCODERS:
+            raise ValueError ("FrameEncoder: unknown format %s" % format)
+
+        self.format  = format
+        self.options = options
+        self.queue   = Queue (maxsize=max_pending)
+        self.error   = None
+
+        self.thread  = threading.Thread (target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run (self):
+
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            surface, f = job
+            try:
+                encode (surface, f, self.format, **self.options)
+            except Exception as e:
+                self.error = e
+
+    def _check (self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def submit (self, surface, f):
+        """ queue surface for encoding into f (file-like object or file name) """
+        self._check()
+        self.queue.put ((surface, f))
+
+    def close (self):
+        """ wait for all queued frames to be written """
+        self.queue.put (None)
+        self.thread.join()
+        self._check()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2016 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# spatial index over the border boxes of a laid out LayoutBox tree
+#
+
+import math
+
+try:
+    from layout import intersect_rects
+except:
+    from .layout import intersect_rects
+
+class SpatialIndex(object):
+    """ Uniform grid of cell_size x cell_size cells. Every box is registered in all cells
+    its visible border box (clipped by overflow: hidden ancestors) touches, queries return
+    boxes in document (= paint) order. """
+
+    def __init__(self, root, cell_size=128.0):
+
+        self.cell_size = cell_size
+        self.cells     = {}  # (col, row) -> [entry, ...]
+        self.entries   = []  # (order, box, x0, y0, x1, y1, clip)
+
+        stack = [(root, None)]
+        while stack:
+            box, clip = stack.pop()
+
+            if box.is_clipping():
+                child_clip = box.clip_rect (clip)
+            else:
+                child_clip = clip
+            for child in reversed(box.children):
+                if not child.clipped:
+                    stack.append ((child, child_clip))
+
+            bb   = box.dimensions.border_box()
+            rect = (bb.x, bb.y, bb.x + bb.width, bb.y + bb.height)
+            if clip is not None:
+                rect = intersect_rects (rect, clip)
+            if rect[2] <= rect[0] or rect[3] <= rect[1]:
+                continue
+
+            entry = (len(self.entries), box, rect[0], rect[1], rect[2], rect[3], clip)
+            self.entries.append (entry)
+
+            for cell in self._cells (entry[2], entry[3], entry[4], entry[5]):
+                if cell in self.cells:
+                    self.cells[cell].append (entry)
+                else:
+                    self.cells[cell] = [entry]
+
+    def _cells (self, x0, y0, x1, y1):
+        cs = self.cell_size
+        for row in range (int(math.floor(y0 / cs)), int(math.floor(y1 / cs)) + 1):
+            for col in range (int(math.floor(x0 / cs)), int(math.floor(x1 / cs)) + 1):
+                yield (col, row)
+
+    def query (self, x0, y0, x1, y1):
+        """ entries whose border box intersects the rectangle, in document order """
+
+        found = {}
+        for cell in self._cells (x0, y0, x1, y1):
+            for entry in self.cells.get (cell, ()):
+                if entry[2] < x1 and entry[4] > x0 and entry[3] < y1 and entry[5] > y0:
+                    found[entry[0]] = entry
+
+        return [found[order] for order in sorted(found)]
+
+    def at (self, x, y):
+        """ entries whose border box contains the point, in document order """
+
+        cs   = self.cell_size
+        cell = (int(math.floor(x / cs)), int(math.floor(y / cs)))
+
+        found = [entry for entry in self.cells.get (cell, ())
+                 if entry[2] <= x < entry[4] and entry[3] <= y < entry[5]]
+        found.sort (key=lambda entry: entry[0])
+
+        return found
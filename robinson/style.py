@@ -100,11 +100,24 @@ class Value (object):
 
         return None
 
+    def __eq__ (self, other):
+        if not isinstance (other, Value):
+            return False
+        return self.type == other.type and self.value == other.value and self.unit == other.unit
+
+    def __ne__ (self, other):
+        return not self.__eq__ (other)
+
+    def __hash__ (self):
+        return hash ((self.type, self.value, self.unit))
+
     def __str__ (self):
         return 'Value(%s, %s, %s)' % (self.type, repr(self.value), repr(self.unit))
 
 # we need this in all sorts of places
-zero = Value ('DIMENSION', 0.0, 'px')
+zero       = Value ('DIMENSION', 0.0, 'px')
+auto       = Value ('IDENT', 'auto')
+align_left = Value ('IDENT', 'left')
 
 def get_style_string (key, styles, default = ''):
 
@@ -113,3 +126,8 @@ def get_style_string (key, styles, default = ''):
 
     return styles[key][1].to_str()
 
+def style_values (styles):
+    """ strip priorities from a style map entry: {name: (prio, value)} -> {name: value} """
+
+    return dict ((key, styles[key][1]) for key in styles)
+